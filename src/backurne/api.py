@@ -6,6 +6,8 @@ from flask import Blueprint
 from flask import Flask
 from flask_autoindex import AutoIndexBlueprint
 
+from . import counters
+from . import progress
 from .disk import get_mapped
 from .disk import prepare_tree_to_json
 from .restore import Restore
@@ -91,6 +93,16 @@ def unmap(rbd, snap):
     return send_json({"success": True})
 
 
+@app.route("/progress/")
+def transfers():
+    return send_json(progress.read())
+
+
+@app.route("/progress/runs/")
+def runs():
+    return send_json(counters.read())
+
+
 @app.route("/mapped/")
 def mapped():
     data = get_mapped(extended=False)
@@ -0,0 +1,432 @@
+import json
+import os
+
+import sh
+
+from .config import config
+from .log import log as Log
+
+
+class Error(Exception):
+    pass
+
+
+class NotFound(Error):
+    pass
+
+
+class CliBackend:
+    # Talks to the cluster through the rbd command line, possibly
+    # through ssh or some helper (see Ceph.__get_helper__)
+    def __init__(self, ceph):
+        self.ceph = ceph
+
+    def __run(self, *args):
+        self.ceph.ready()
+        try:
+            return self.ceph.cmd(args)
+        except sh.ErrorReturnCode as e:
+            raise Error(e.stderr.decode("utf-8").rstrip()) from e
+
+    def __fetch(self, *args):
+        self.ceph.ready()
+        try:
+            result = self.ceph.json(args)
+        except sh.ErrorReturnCode as e:
+            raise Error(e.stderr.decode("utf-8").rstrip()) from e
+        return json.loads(result.stdout.decode("utf-8"))
+
+    def __esc(self, snap):
+        if self.ceph.esc is True:
+            return f"'{snap}'"
+        return snap
+
+    def ls(self):
+        return self.__fetch("ls")
+
+    def entries(self):
+        return self.__fetch("ls", "--long")
+
+    def info(self, spec):
+        return self.__fetch("info", self.__esc(spec))
+
+    def du(self, image=None):
+        if image is None:
+            return self.__fetch("du")
+        return self.__fetch("du", image)
+
+    def snaps(self, image):
+        return [i["name"] for i in self.__fetch("snap", "ls", image)]
+
+    def snap_entries(self, image):
+        # Names and protection flags, from a single listing
+        return [
+            {"name": i["name"], "protected": i.get("protected") in (True, "true")}
+            for i in self.__fetch("snap", "ls", image)
+        ]
+
+    def exists(self, image):
+        try:
+            self.__run("info", image)
+            return True
+        except Error:
+            return False
+
+    def create(self, image, size):
+        # rbd wants megabytes
+        self.__run("create", image, "-s", f"{max(size >> 20, 1)}M")
+
+    def rm(self, image):
+        self.__run("rm", image)
+
+    def rename(self, image, dest):
+        self.__run("mv", image, dest)
+
+    def snap_create(self, image, snap):
+        self.__run("snap", "create", "--snap", self.__esc(snap), image)
+
+    def snap_rm(self, image, snap):
+        self.__run("snap", "rm", "--snap", self.__esc(snap), image)
+
+    def snap_purge(self, image):
+        self.__run("snap", "purge", image)
+
+    def is_protected(self, image, snap):
+        return self.info(f"{image}@{snap}")["protected"] == "true"
+
+    def protect(self, image, snap):
+        self.__run("snap", "protect", f"{image}@{snap}")
+
+    def unprotect(self, image, snap):
+        self.__run("snap", "unprotect", f"{image}@{snap}")
+
+
+# One cluster handle per process, shared by every LibrbdBackend
+# librados handles do not survive a fork, hence the pid tracking
+cluster = None
+cluster_pid = None
+
+
+def get_cluster():
+    global cluster, cluster_pid
+    import rados
+
+    if cluster is not None and cluster_pid == os.getpid():
+        return cluster
+
+    conf = config["backup_cluster"]
+    cluster = rados.Rados(
+        conffile=conf.get("conffile", "/etc/ceph/ceph.conf"),
+        name=conf.get("client", "client.admin"),
+    )
+    cluster.connect()
+    cluster_pid = os.getpid()
+    return cluster
+
+
+class LibrbdBackend:
+    # Talks to the backup cluster in-process, via python3-rbd
+    def __init__(self, pool, namespace=None):
+        import rados
+        import rbd
+
+        self.pool = pool
+        self.namespace = namespace
+        self.errors = (rados.Error, rbd.Error)
+        self.ioctx = None
+        self.ioctx_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["ioctx"] = None
+        return state
+
+    def __ioctx(self):
+        if self.ioctx is None or self.ioctx_pid != os.getpid():
+            self.ioctx = get_cluster().open_ioctx(self.pool)
+            if self.namespace is not None:
+                self.ioctx.set_namespace(self.namespace)
+            self.ioctx_pid = os.getpid()
+        return self.ioctx
+
+    def __image(self, image, read_only=False):
+        import rbd
+
+        try:
+            return rbd.Image(self.__ioctx(), image, read_only=read_only)
+        except rbd.ImageNotFound as e:
+            raise NotFound(f"{image} does not exist") from e
+        except self.errors as e:
+            raise Error(e) from e
+
+    def __snaps(self, img):
+        result = []
+        for snap in img.list_snaps():
+            snap["protected"] = img.is_protected_snap(snap["name"])
+            result.append(snap)
+        return result
+
+    def ls(self):
+        import rbd
+
+        return rbd.RBD().list(self.__ioctx())
+
+    def entries(self):
+        result = []
+        for image in self.ls():
+            try:
+                img = self.__image(image, read_only=True)
+            except NotFound:
+                # Removed while we were listing
+                continue
+            with img:
+                result.append({"image": image, "size": img.size()})
+                for snap in self.__snaps(img):
+                    result.append(
+                        {
+                            "image": image,
+                            "snapshot": snap["name"],
+                            "snapshot_id": snap["id"],
+                            "size": snap["size"],
+                            "protected": "true" if snap["protected"] else "false",
+                        }
+                    )
+        return result
+
+    def info(self, spec):
+        image, _, snap = spec.partition("@")
+        with self.__image(image, read_only=True) as img:
+            result = {"name": image, "size": img.size()}
+            try:
+                parent = img.get_parent_image_spec()
+                result["parent"] = {
+                    "pool": parent["pool_name"],
+                    "image": parent["image_name"],
+                    "snapshot": parent["snap_name"],
+                }
+            except self.errors:
+                # Not a clone
+                pass
+            if snap != "":
+                protected = img.is_protected_snap(snap)
+                result["protected"] = "true" if protected else "false"
+        return result
+
+    def du(self, image=None):
+        # Computing the usage requires walking every object, let rbd do it
+        cmd = sh.Command("rbd").bake("-p", self.pool, "--format", "json")
+        if self.namespace is not None:
+            cmd = cmd.bake("--namespace", self.namespace)
+        if image is None:
+            return json.loads(cmd("du").stdout.decode("utf-8"))
+        return json.loads(cmd("du", image).stdout.decode("utf-8"))
+
+    def snaps(self, image):
+        with self.__image(image, read_only=True) as img:
+            return [i["name"] for i in img.list_snaps()]
+
+    def snap_entries(self, image):
+        with self.__image(image, read_only=True) as img:
+            return [
+                {"name": i["name"], "protected": i["protected"]}
+                for i in self.__snaps(img)
+            ]
+
+    def exists(self, image):
+        try:
+            self.__image(image, read_only=True).close()
+            return True
+        except NotFound:
+            return False
+
+    def create(self, image, size):
+        import rbd
+
+        try:
+            rbd.RBD().create(self.__ioctx(), image, size)
+        except self.errors as e:
+            raise Error(e) from e
+
+    def rm(self, image):
+        import rbd
+
+        try:
+            rbd.RBD().remove(self.__ioctx(), image)
+        except self.errors as e:
+            raise Error(e) from e
+
+    def rename(self, image, dest):
+        import rbd
+
+        try:
+            rbd.RBD().rename(self.__ioctx(), image, dest)
+        except self.errors as e:
+            raise Error(e) from e
+
+    def __snap_op(self, image, op, snap):
+        with self.__image(image) as img:
+            try:
+                return getattr(img, op)(snap)
+            except self.errors as e:
+                raise Error(e) from e
+
+    def snap_create(self, image, snap):
+        self.__snap_op(image, "create_snap", snap)
+
+    def snap_rm(self, image, snap):
+        self.__snap_op(image, "remove_snap", snap)
+
+    def snap_purge(self, image):
+        # Same image handle for all of them
+        with self.__image(image) as img:
+            try:
+                for snap in [i["name"] for i in img.list_snaps()]:
+                    img.remove_snap(snap)
+            except self.errors as e:
+                raise Error(e) from e
+
+    def is_protected(self, image, snap):
+        with self.__image(image, read_only=True) as img:
+            return img.is_protected_snap(snap)
+
+    def protect(self, image, snap):
+        self.__snap_op(image, "protect_snap", snap)
+
+    def unprotect(self, image, snap):
+        self.__snap_op(image, "unprotect_snap", snap)
+
+
+class FakeBackend:
+    # An in-memory pool, to exercise the code without any Ceph cluster
+    # Only meant for testing: nothing is persisted, nor shared between processes
+    def __init__(self, pool=None, namespace=None):
+        self.pool = pool
+        self.namespace = namespace
+        self.images = {}
+        self.next_id = 1
+
+    def __get(self, image):
+        try:
+            return self.images[image]
+        except KeyError:
+            raise NotFound(f"{image} does not exist")
+
+    def __snap(self, image, snap):
+        try:
+            return self.__get(image)["snaps"][snap]
+        except KeyError:
+            raise NotFound(f"{image}@{snap} does not exist")
+
+    def ls(self):
+        return list(self.images.keys())
+
+    def entries(self):
+        result = []
+        for name, image in self.images.items():
+            result.append({"image": name, "size": image["size"]})
+            for snap, data in image["snaps"].items():
+                result.append(
+                    {
+                        "image": name,
+                        "snapshot": snap,
+                        "snapshot_id": data["id"],
+                        "size": data["size"],
+                        "protected": "true" if data["protected"] else "false",
+                    }
+                )
+        return result
+
+    def info(self, spec):
+        image, _, snap = spec.partition("@")
+        result = {"name": image, "size": self.__get(image)["size"]}
+        if snap != "":
+            protected = self.__snap(image, snap)["protected"]
+            result["protected"] = "true" if protected else "false"
+        return result
+
+    def du(self, image=None):
+        result = []
+        for name, data in self.images.items():
+            if image is not None and name != image:
+                continue
+            result.append(
+                {"name": name, "provisioned_size": data["size"], "used_size": 0}
+            )
+        return {"images": result}
+
+    def snaps(self, image):
+        return list(self.__get(image)["snaps"].keys())
+
+    def snap_entries(self, image):
+        return [
+            {"name": snap, "protected": data["protected"]}
+            for snap, data in self.__get(image)["snaps"].items()
+        ]
+
+    def exists(self, image):
+        return image in self.images
+
+    def create(self, image, size):
+        if image in self.images:
+            raise Error(f"{image} already exists")
+        self.images[image] = {"size": size, "snaps": {}}
+
+    def rm(self, image):
+        if len(self.__get(image)["snaps"]) != 0:
+            raise Error(f"{image} still has snapshots")
+        del self.images[image]
+
+    def rename(self, image, dest):
+        if dest in self.images:
+            raise Error(f"{dest} already exists")
+        self.images[dest] = self.images.pop(image)
+
+    def snap_create(self, image, snap):
+        data = self.__get(image)
+        if snap in data["snaps"]:
+            raise Error(f"{image}@{snap} already exists")
+        data["snaps"][snap] = {
+            "id": self.next_id,
+            "size": data["size"],
+            "protected": False,
+        }
+        self.next_id += 1
+
+    def snap_rm(self, image, snap):
+        if self.__snap(image, snap)["protected"]:
+            raise Error(f"{image}@{snap} is protected")
+        del self.images[image]["snaps"][snap]
+
+    def snap_purge(self, image):
+        for snap in list(self.__get(image)["snaps"]):
+            self.snap_rm(image, snap)
+
+    def is_protected(self, image, snap):
+        return self.__snap(image, snap)["protected"]
+
+    def protect(self, image, snap):
+        self.__snap(image, snap)["protected"] = True
+
+    def unprotect(self, image, snap):
+        self.__snap(image, snap)["protected"] = False
+
+
+def get_backend(ceph):
+    if not ceph.is_backup:
+        return CliBackend(ceph)
+
+    kind = config["backup_cluster"].get("backend", "cli")
+    if kind == "librbd":
+        try:
+            return LibrbdBackend(ceph.pool, ceph.namespace)
+        except ImportError:
+            Log.warning("python3-rbd is not available, falling back to rbd cli")
+    elif kind == "fake":
+        key = (ceph.pool, ceph.namespace)
+        if key not in fakes:
+            fakes[key] = FakeBackend(ceph.pool, ceph.namespace)
+        return fakes[key]
+    return CliBackend(ceph)
+
+
+fakes = {}
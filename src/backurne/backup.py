@@ -1,7 +1,7 @@
 import datetime
 
-import dateutil.parser
-
+from . import snapshot
+from . import state
 from .config import config
 from .log import log as Log
 
@@ -53,23 +53,53 @@ class Bck:
         snaps = self.ceph.backup.snap(self.dest)
         good = []
         for snap in snaps:
-            split = snap.split(";")
-            if split[1] != profile:
+            # Coalesced snapshots count for each of their profiles
+            if profile not in snapshot.parse(snap).profiles:
                 continue
             good.append(snap)
         return self.ceph.get_last_snap(good)
 
+    def __resume(self, snap_name, dest, last_snap):
+        # Some previous transfers to dest may have been interrupted
+        # If possible, we finish them, and use them as our base
+        for snap, base in state.interrupted(dest):
+            if snap == snap_name:
+                continue
+            checkpoint = state.Checkpoint(dest, snap, base)
+
+            # The partial data must lay on top of its base snapshot
+            # Else, it has already been overwritten by another transfer
+            backup_last = self.ceph.get_last_snap(self.ceph.backup.snap(dest))
+            if base != backup_last or snap not in self.ceph.snap(self.rbd):
+                Log.debug(f"Dropping the checkpoint of {dest}@{snap}")
+                checkpoint.drop()
+                continue
+
+            Log.info(f"Resuming the interrupted transfer of {self.source} {snap}")
+            self.ceph.do_backup(self.rbd, snap, dest, base)
+            last_snap = self.ceph.get_last_snap([snap, last_snap or snap])
+        return last_snap
+
     def dl_snap(self, snap_name, dest, last_snap):
         Log.debug(f"Exporting {self.source} {snap_name}")
         if not self.ceph.backup.exists(dest):
             # Create a dummy image, on our backup cluster,
             # which will receive a full snapshot
-            self.ceph.backup("create", dest, "-s", "1")
+            self.ceph.backup.create(dest)
+            # The partial data of older transfers is gone with the image
+            state.drop_checkpoints(dest)
+        else:
+            last_snap = self.__resume(snap_name, dest, last_snap)
 
-        self.ceph.do_backup(self.rbd, snap_name, dest, last_snap)
+        size = self.ceph.do_backup(self.rbd, snap_name, dest, last_snap)
         Log.debug(f"Export {self.source} {snap_name} complete")
+        return size
 
     def check_profile(self, profile):
+        # A coalesced profile is due if any of its profiles is
+        return any(self.__due(i) for i in profile.split(","))
+
+    def __due(self, profile):
         try:
             last_profile = self.__last_snap_profile(profile)
         except Exception:
@@ -86,8 +116,7 @@ class Bck:
             delta = datetime.timedelta(days=7)
         not_after = datetime.datetime.now() - delta
         if last_profile is not None:
-            last_time = last_profile.split(";")[3]
-            last_time = dateutil.parser.parse(last_time)
+            last_time = snapshot.parse(last_profile).date
             if last_time > not_after:
                 Log.debug("Our last backup is still young, nothing to do")
                 return False
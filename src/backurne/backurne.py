@@ -1,30 +1,42 @@
 import argparse
 import atexit
+import concurrent.futures
 import datetime
 import json
 import multiprocessing
-import queue
+import multiprocessing.connection
+import os
 import signal
 import sqlite3
-import time
 from functools import wraps
 
-import dateutil.parser
 import filelock
+import humanize
 import progressbar
 import requests
 import setproctitle
 import sh
 
+from . import cache
+from . import counters
+from . import estimate
+from . import inventory
+from . import journal
 from . import pretty
+from . import progress
+from . import retention
+from . import scheduler
+from . import snapshot
 from . import stats
 from .backup import Bck
 from .ceph import Ceph
 from .config import config
+from .config import load_config
 from .disk import get_mapped
 from .disk import prepare_tree_to_json
 from .disk import print_mapped
 from .log import log as Log
+from .manifest import Manifests
 from .proxmox import Proxmox
 from .restore import Restore
 
@@ -71,8 +83,7 @@ class Check:
             msg = f"No backup found for {backup} at {ceph} (no shared snap)"
             return {"image": rbd, "msg": msg}
 
-        when = last.split(";")[3]
-        when = dateutil.parser.parse(when)
+        when = snapshot.parse(last).date
         deadline = datetime.timedelta(days=1) + datetime.timedelta(hours=6)
         deadline = datetime.datetime.now() - deadline
         if when < deadline:
@@ -88,25 +99,112 @@ class Check:
             msg = f"Snapshot {backup.dest} / {snap} was not deleted in time, please investigate (may be protected or mapped)."
             return {"image": rbd, "msg": msg}
 
-    def cmp_snap(self, backup, ceph, rbd):
+    def manifests(self, ceph, image, snaps, wanted, full, slot=None):
+        # Runs in its own thread: sqlite connections are per-thread
+        if slot is not None:
+            slot.acquire()
+        try:
+            manifests = Manifests(ceph, image, snaps, full)
+            return {snap: manifests.get(snap) for snap in wanted}
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def cmp_snap(self, args):
+        # An image that cannot be checked is an error too
+        try:
+            return self.__cmp_snap(args)
+        except Exception as e:
+            Log.warning(f"{e} thrown while checking {args['image']}")
+            msg = f"ERR: cannot check {args['image']} against its backup: {e}"
+            return [{"image": args["image"], "msg": msg}]
+
+    def __cmp_snap(self, args):
+        ceph = args["ceph"]
+        backup = args["backup"]
+        rbd = args["image"]
+
         live_snaps = ceph.snap(rbd)
         try:
             backup_snaps = ceph.backup.snap(backup.dest)
         except Exception:
             backup_snaps = []
-        inter = list(set(live_snaps).intersection(backup_snaps))
+        # Oldest first: each manifest is derived from the previous one
+        inter = [i for i in live_snaps if i in backup_snaps]
+        if len(inter) == 0:
+            return []
+
+        # Both sides are hashed concurrently
+        # Only the live side is bound by the cluster's slots
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            live = executor.submit(
+                self.manifests,
+                ceph,
+                rbd,
+                live_snaps,
+                inter,
+                args["full"],
+                args["slot"],
+            )
+            back = executor.submit(
+                self.manifests,
+                ceph.backup,
+                backup.dest,
+                backup_snaps,
+                inter,
+                args["full"],
+            )
+            live = live.result()
+            back = back.result()
+
+        result = []
         for snap in inter:
             Log.debug(f"checking {rbd} @ {snap}")
-            live = ceph.checksum(rbd, snap)
-            back = ceph.backup.checksum(backup.dest, snap)
-            if live == back:
+            diff = live[snap].diff(back[snap])
+            if diff == []:
                 continue
 
-            err = {
-                "image": rbd,
-                "msg": f"ERR: shared snapshot {snap} does not match\n\tOn live (image: {rbd}): {live}\n\tOn backup (image: {backup.dest}): {back}",
-            }
-            self.add_err(err)
+            if diff is None:
+                msg = (
+                    f"sizes differ: {live[snap].size} on live, "
+                    f"{back[snap].size} on backup"
+                )
+            else:
+                offsets = ", ".join(str(i) for i in diff[:10])
+                if len(diff) > 10:
+                    offsets += ", .."
+                msg = f"{len(diff)} chunks differ, at offsets {offsets}"
+            result.append(
+                {
+                    "image": rbd,
+                    "msg": f"ERR: shared snapshot {snap} does not match\n\tOn live (image: {rbd}) and on backup (image: {backup.dest}): {msg}",
+                }
+            )
+        return result
+
+    def check_snap(self, full=False):
+        data = self.snap_items()
+        load_inventories([i["ceph"] for i in data])
+
+        self.err = []
+        with multiprocessing.Manager() as manager:
+            # Bound the load put on each live endpoint
+            # Clusters reached via a helper have no endpoint: use their name
+            slots = {}
+            for i in data:
+                key = i["ceph"].endpoint or i["ceph"].name
+                if key not in slots:
+                    slots[key] = manager.BoundedSemaphore(
+                        config["check_endpoint_worker"]
+                    )
+                i["slot"] = slots[key]
+                i["full"] = full
+
+            with multiprocessing.Pool(config["check_worker"]) as pool:
+                for errs in pool.imap_unordered(self.cmp_snap, data):
+                    for err in errs or []:
+                        self.add_err(err)
+        return self.err
 
 
 class CheckProxmox(Check):
@@ -120,6 +218,8 @@ class CheckProxmox(Check):
             for disk, ceph, bck in vm["to_backup"]:
                 data.append({"ceph": ceph, "backup": bck, "image": disk["rbd"]})
 
+        load_inventories([i["ceph"] for i in data])
+
         self.err = []
         with multiprocessing.Pool() as pool:
             for msg in pool.imap_unordered(self.check_img, data):
@@ -127,11 +227,12 @@ class CheckProxmox(Check):
 
         return self.err
 
-    def check_snap(self):
+    def snap_items(self):
+        data = []
         for vm in self.px.vms():
             for disk, ceph, bck in vm["to_backup"]:
-                self.cmp_snap(bck, ceph, disk["rbd"])
-        return self.err
+                data.append({"ceph": ceph, "backup": bck, "image": disk["rbd"]})
+        return data
 
 
 class CheckPlain(Check):
@@ -145,6 +246,8 @@ class CheckPlain(Check):
         )
 
     def check(self):
+        load_inventories([self.ceph])
+
         data = []
         for rbd in self.ceph.ls():
             bck = Bck(self.cluster["name"], self.ceph, rbd)
@@ -157,11 +260,24 @@ class CheckPlain(Check):
 
         return self.err
 
-    def check_snap(self):
+    def snap_items(self):
+        data = []
         for rbd in self.ceph.ls():
             bck = Bck(self.cluster["name"], self.ceph, rbd)
-            self.cmp_snap(bck, self.ceph, rbd)
-        return self.err
+            data.append({"ceph": self.ceph, "backup": bck, "image": rbd})
+        return data
+
+
+def load_inventories(cephs):
+    # Each pool is listed once per process, and inherited by its workers
+    # The backup pool is listed by the main process, before any fork
+    loaded = set()
+    for ceph in cephs:
+        for i in (ceph, ceph.backup):
+            if i.key in loaded or i.inventory is not None:
+                continue
+            loaded.add(i.key)
+            i.load_inventory()
 
 
 def run_hook(kind, vmname, diskname):
@@ -170,51 +286,39 @@ def run_hook(kind, vmname, diskname):
 
 
 class Backup:
-    def __init__(self, cluster, regular_queue, priority_queue, status_queue, args=None):
+    def __init__(self, cluster, scheduler, counters, args=None):
         self.cluster = cluster
-        self.regular_queue = regular_queue
-        self.priority_queue = priority_queue
-        self.status_queue = status_queue
+        self.scheduler = scheduler
+        self.counters = counters
         self.args = args
 
-    def is_expired(snap, last=False):
-        split = snap.split(";")
-        created_at = dateutil.parser.parse(split[-1])
-        profile = split[-3]
-        value = int(split[-2])
-        if profile == "daily":
-            expiration = datetime.timedelta(days=value)
-        elif profile == "hourly":
-            expiration = datetime.timedelta(hours=value)
-        elif profile == "weekly":
-            expiration = datetime.timedelta(days=7 * value)
-        elif profile == "monthly":
-            expiration = datetime.timedelta(days=30 * value)
-        else:
-            Log.warning(f"Unknown profile found, no action taken: {profile}")
-            return False
-
-        expired_at = created_at + expiration
-        if last is True:
-            expired_at += datetime.timedelta(days=config["extra_retention_time"])
+    def count(self, phase, **values):
+        self.counters.add(self.cluster["name"], phase, **values)
 
-        now = datetime.datetime.now()
-        if expired_at > now:
-            return False
-        return True
+    def is_expired(snap, last=False):
+        return snapshot.parse(snap).is_expired(last)
 
     def _create_snap(self, bck, profiles, pre_vm_hook):
         todo = []
-        is_high_prio = False
+        prio = None
 
         hooked = False
 
         try:
             with Lock(bck.dest):
+                if self.args.resume:
+                    todo, prio = self._pending(bck)
+                if len(todo) != 0:
+                    # Left by an interrupted run: no new snapshot
+                    Log.info(f"Resuming {len(todo)} transfers of {bck.source}")
+                    profiles = []
+                elif config["coalesce_profiles"]:
+                    profiles = self._coalesce(bck, profiles)
+
                 for profile, value in profiles:
-                    self.status_queue.put("add_item")
+                    self.count("snapshot", total=1)
                     if not self.args.force and not bck.check_profile(profile):
-                        self.status_queue.put("done_item")
+                        self.count("snapshot", done=1)
                         continue
 
                     if pre_vm_hook is False:
@@ -229,7 +333,7 @@ class Backup:
                                 "pre_vm hook failed on %s/%s with code %s : %s"
                                 % (bck.vm["name"], bck.rbd, e.exit_code, out)
                             )
-                            self.status_queue.put("done_item")
+                            self.count("snapshot", done=1)
                             return None
                         hooked = True
 
@@ -246,12 +350,13 @@ class Backup:
                             "pre_disk hook failed on %s/%s with code %s : %s"
                             % (bck.vm["name"], bck.rbd, e.exit_code, out)
                         )
-                        self.status_queue.put("done_item")
+                        self.count("snapshot", done=1)
                         continue
                     setproctitle.setproctitle(
                         f"Backurne: snapshooting {bck.rbd} on {bck.name}"
                     )
                     dest, last_snap, snap_name = bck.make_snap(profile, value["count"])
+                    self.count("snapshot", done=1)
 
                     try:
                         run_hook("post_disk", bck.vm["name"], bck.rbd)
@@ -268,32 +373,104 @@ class Backup:
                             }
                         )
 
-                        priority = value.get("priority")
-                        if priority == "high":
-                            is_high_prio = True
+                        # The VM goes with its most urgent profile
+                        priority = scheduler.priority(value.get("priority"))
+                        if prio is None or priority > prio:
+                            prio = priority
+
+                        name = self.cluster["name"]
+                        journal.snapshotted(name, dest, snap_name, last_snap, priority)
         except filelock.Timeout:
             Log.info(f"unable to acquire lock for {bck.vm['name']}")
             pass
         if len(todo) != 0:
-            if is_high_prio:
-                self.priority_queue.put(todo)
-            else:
-                self.regular_queue.put(todo)
+            size = 0
+            for i in todo:
+                guess = estimate.estimate(
+                    bck.ceph, bck.rbd, i["snap_name"], i["last_snap"]
+                )
+                estimate.record(i["dest"], i["snap_name"], guess)
+                self.count("transfer", total=1, bytes_total=guess or 0)
+                if guess is not None and size is not None:
+                    size += guess
+                else:
+                    size = None
+            self.scheduler.put(todo, prio, estimate.size_key(size))
         setproctitle.setproctitle("Backurne idle producer")
         return hooked
 
+    def _coalesce(self, bck, profiles):
+        # Every due profile goes into a single snapshot, hence a single
+        # transfer, kept as long as the longest of them
+        due = []
+        for profile, value in profiles:
+            if self.args.force or bck.check_profile(profile):
+                due.append((profile, value))
+                continue
+            self.count("snapshot", total=1, done=1)
+        if len(due) < 2:
+            return due
+
+        name = ",".join(profile for profile, _ in due)
+        count = ",".join(str(value["count"]) for _, value in due)
+        prio = max((value.get("priority") for _, value in due), key=scheduler.priority)
+        return [(name, {"count": count, "priority": prio})]
+
+    def _pending(self, bck):
+        # Snapshots of bck that previous runs created, but did not transfer
+        todo = []
+        prio = None
+        live = bck.ceph.snap(bck.rbd)
+        backups = []
+        if bck.ceph.backup.exists(bck.dest):
+            backups = bck.ceph.backup.snap(bck.dest)
+        newest = snapshot.last(backups)
+        limit = snapshot.sort_key(newest) if newest is not None else None
+
+        for snap, last_snap, priority in journal.pending(bck.dest):
+            if snap in backups:
+                # Interrupted right after its transfer
+                journal.update(bck.dest, snap, journal.TRANSFERRED)
+                continue
+            if snap not in live:
+                Log.debug(f"{bck.source}@{snap} no longer exists, cannot resume")
+                journal.drop(bck.dest, snap)
+                continue
+            if limit is not None and snapshot.sort_key(snap) < limit:
+                Log.debug(f"{bck.source}@{snap} is older than its backups, dropped")
+                journal.drop(bck.dest, snap)
+                continue
+            todo.append(
+                {
+                    "dest": bck.dest,
+                    "last_snap": last_snap,
+                    "snap_name": snap,
+                    "backup": bck,
+                }
+            )
+            if prio is None or priority > prio:
+                prio = priority
+            # Now ours, should we be interrupted as well
+            journal.snapshotted(
+                self.cluster["name"], bck.dest, snap, last_snap, priority
+            )
+        return todo, prio
+
+    def load_inventories(self, items):
+        if self.args.vmid is not None:
+            # A single VM is processed, bulk listing is not worth it
+            return
+        load_inventories(self.cephs(items))
+
     def create_snaps(self):
         items = self.list()
+        self.load_inventories(items)
         with multiprocessing.Pool(config["live_worker"]) as pool:
             for i in pool.imap_unordered(self.create_snap, items):
                 pass
 
-    def _custom_key(self, item):
-        return item.split(";")[3]
-
     def _expire_item(self, ceph, disk, vm=None):
-        self.status_queue.put("add_item")
-        self.status_queue.put("done_item")
+        self.count("expire", total=1, done=1)
 
         if vm is not None:
             bck = Bck(disk["ceph"], ceph, disk["rbd"], vm=vm, adapter=disk["adapter"])
@@ -302,98 +479,71 @@ class Backup:
             bck = Bck(self.cluster["name"], ceph, disk)
             rbd = disk
 
-        backups = Ceph(None).snap(bck.dest)
-
+        backups = ceph.backup.snap(bck.dest)
         snaps = ceph.snap(rbd)
-        shared = list(set(backups).intersection(snaps))
-
-        try:
-            shared.sort(key=self._custom_key)
-            shared = shared.pop()
-        except IndexError:
-            shared = None
-
-        by_profile = {}
-        for snap in snaps:
-            # The last shared snapshot must be kept
-            # Also, subsequent snaps shall be kept as well,
-            # because a backup may be pending elsewhere
-            if shared is None or snap.split(";")[3] >= shared.split(";")[3]:
-                continue
-            tmp = snap.split(";")
-            if tmp[1] not in by_profile:
-                by_profile[tmp[1]] = []
-            i = by_profile[tmp[1]]
-            i.append(snap)
-
-        to_del = []
-        for profile, snaps in by_profile.items():
-            try:
-                profile = config["profiles"][profile]
-            except KeyError:
-                # Profile no longer exists, we can drop all these snaps
-                to_del += snaps
-                continue
-            try:
-                max_on_live = profile["max_on_live"]
-            except KeyError:
-                max_on_live = 1
-
-            for _ in range(0, max_on_live):
-                try:
-                    snaps.pop()
-                except IndexError:
-                    # We do not have enough snaps on live
-                    # snaps is now an empty list, nothing to delete
-                    break
-
-            to_del += snaps
-        for i in to_del:
+        for i in retention.plan_live(snaps, backups):
             ceph.rm_snap(rbd, i)
 
     def expire_live(self):
+        # Returns the backup images of the cluster
         items = self.list()
+        self.load_inventories(items)
         with multiprocessing.Pool(config["live_worker"]) as pool:
             for i in pool.imap_unordered(self.expire_item, items):
                 pass
+        return self.dests(items)
 
-    @handle_exc
     def expire_backup(i):
+        # Applies the plan of one image, see retention.plan_image
         ceph = i["ceph"]
-        image = i["image"]
-        i["status_queue"].put("done_item")
-
-        with Lock(image):
-            snaps = ceph.snap(image)
-            try:
-                # Pop the last snapshot
-                # We will take care of it later
-                last = snaps.pop()
-            except IndexError:
-                # We found an image without snapshot
-                # Someone is messing around, or this is a bug
-                # Anyway, the image can be deleted
-                ceph.rm(image)
-                return
-
-            for snap in snaps:
-                if not Backup.is_expired(snap):
-                    continue
-                ceph.rm_snap(image, snap)
-
-            snaps = ceph.snap(image)
-            if len(snaps) == 1:
-                if Backup.is_expired(last, last=True):
-                    ceph.rm_snap(image, snaps[0])
+        image = i["plan"]["image"]
 
-            if len(ceph.snap(image)) == 0:
-                Log.debug(f"{image} has no snapshot left, deleting")
-                ceph.rm(image)
+        result = retention.result()
+        result["protected"] = [f"{image}@{snap}" for snap in i["plan"]["protected"]]
+        try:
+            with Lock(image):
+                if not ceph.backend.exists(image):
+                    Log.debug(f"{image} no longer exists, nothing to expire")
+                    return result
+                plan = retention.recheck(i["plan"], ceph.backend.snaps(image))
+
+                todo = plan["snaps"]
+                if plan["purge"] and ceph.purge_snaps(image):
+                    result["snaps"] += len(todo)
+                    result["removed"] += [(image, snap) for snap in todo]
+                    todo = []
+
+                failed = False
+                for snap in todo:
+                    if failed and plan["last"] and snap == todo[-1]:
+                        # The last snapshot only goes with all the others
+                        break
+                    if ceph.rm_snap(image, snap):
+                        result["snaps"] += 1
+                        result["removed"].append((image, snap))
+                    else:
+                        failed = True
+                        result["failed"].append(f"{image}@{snap}")
+
+                if plan["rm"] and not failed:
+                    Log.debug(f"{image} has no snapshot left, deleting")
+                    if ceph.rm(image):
+                        result["images"] += 1
+                    else:
+                        result["failed"].append(image)
+        except filelock.Timeout:
+            result["locked"].append(image)
+        except Exception as e:
+            Log.warning(f"{e} thrown while expiring {image}")
+            result["failed"].append(image)
+        finally:
+            i["counters"].add(None, "expire", done=1)
+        return result
 
 
 class BackupProxmox(Backup):
-    def __init__(self, cluster, regular_queue, priority_queue, status_queue, args):
-        super().__init__(cluster, regular_queue, priority_queue, status_queue, args)
+    def __init__(self, cluster, scheduler, counters, args):
+        super().__init__(cluster, scheduler, counters, args)
 
     def __fetch_profiles(self, vm, disk):
         profiles = list(config["profiles"].items())
@@ -444,6 +594,20 @@ class BackupProxmox(Backup):
             Log.error(f"{e} thrown while listing vm on {self.cluster['name']}")
         return result
 
+    def cephs(self, items):
+        result = []
+        for vm in items:
+            for disk, ceph, bck in vm["to_backup"]:
+                result.append(ceph)
+        return result
+
+    def dests(self, items):
+        result = []
+        for vm in items:
+            for disk, ceph, bck in vm["to_backup"]:
+                result.append(bck.dest)
+        return result
+
     def filter_profiles(self, profiles, _filter):
         if _filter is None:
             return profiles
@@ -502,8 +666,8 @@ class BackupProxmox(Backup):
 
 
 class BackupPlain(Backup):
-    def __init__(self, cluster, regular_queue, priority_queue, status_queue, args):
-        super().__init__(cluster, regular_queue, priority_queue, status_queue, args)
+    def __init__(self, cluster, scheduler, counters, args):
+        super().__init__(cluster, scheduler, counters, args)
         self.ceph = Ceph(
             self.cluster["pool"],
             namespace=self.cluster.get("namespace"),
@@ -518,6 +682,12 @@ class BackupPlain(Backup):
             Log.warning(e)
             return []
 
+    def cephs(self, items):
+        return [self.ceph]
+
+    def dests(self, items):
+        return [Bck(self.cluster["name"], self.ceph, rbd).dest for rbd in items]
+
     @handle_exc
     def create_snap(self, rbd):
         setproctitle.setproctitle("Backurne idle producer")
@@ -531,78 +701,164 @@ class BackupPlain(Backup):
             self._expire_item(self.ceph, rbd)
 
 
-class Status_updater:
-    class Real_updater:
-        def __init__(self, status_queue, desc):
-            self.todo = 0
-            self.total = 0
-            self.status_queue = status_queue
-            self.desc = desc
-
-            if config["log_level"] != "debug":
-                # progressbar uses signal.SIGWINCH
-                # It messes with multiprocessing, so we break it
-                real_signal = signal.signal
-                signal.signal = None
-                widget = [
-                    progressbar.widgets.SimpleProgress(),
-                    " ",
-                    desc,
-                    " (",
-                    progressbar.widgets.Timer(),
-                    ")",
-                ]
-                self.bar = progressbar.ProgressBar(maxval=1, widgets=widget)
-                signal.signal = real_signal
-
-        @handle_exc
-        def __call__(self):
-            Log.debug("Real_updater started")
-            if config["log_level"] != "debug":
-                self.bar.start()
-            self.__work__()
-            if config["log_level"] != "debug":
-                self.bar.finish()
-            Log.debug("Real_updater ended")
-
-        def __update(self):
-            done = self.total - self.todo
-            msg = f"Backurne : {done}/{self.total} {self.desc}"
-            setproctitle.setproctitle(msg)
-            if config["log_level"] != "debug":
-                self.bar.maxval = self.total
-                self.bar.update(done)
-
-        def __work__(self):
-            while True:
-                try:
-                    msg = self.status_queue.get(block=False)
-                except queue.Empty:
-                    self.__update()
-                    time.sleep(1)
-                    continue
-                if msg == "add_item":
-                    self.total += 1
-                    self.todo += 1
-                elif msg == "done_item":
-                    self.todo -= 1
-                else:
-                    Log.error(f"Unknown message received: {msg}")
-                self.__update()
+def cleanup_backup(args):
+    return (
+        args.cleanup
+        or args.cluster is None
+        and args.profile is None
+        and args.vmid is None
+    )
+
+
+def expire_backups(counters, images=None, skip=()):
+    # Dummy Ceph object used to retrieve the real backup Object
+    # Its inventory, if any, was loaded by the main process
+    ceph = Ceph(None)
+
+    report = retention.Report()
+    if images is None:
+        images = [i for i in ceph.ls() if i not in skip]
+    plans = retention.plan_backup(ceph, images=images)
+
+    data = [{"ceph": ceph, "plan": i, "counters": counters} for i in plans]
+    counters.add(None, "expire", total=len(data))
+    # Images are sent to the workers by batches
+    chunk = max(1, len(data) // (config["backup_worker"] * 4))
+    with multiprocessing.Pool(config["backup_worker"]) as pool:
+        for i in pool.imap_unordered(Backup.expire_backup, data, chunk):
+            report.add(i)
+    return report
+
+
+class Finisher:
+    # Expires a live cluster, then the backup images it owns, as soon as
+    # its own transfers are done: other clusters may still be busy
+    # Runs in a process of its own, and sends back the images it owns
+    def __init__(self, cluster, counters, args):
+        self.cluster = cluster
+        self.counters = counters
+        self.args = args
+
+    def start(self):
+        self.pipe, send = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=self.__run, args=(send,))
+        atexit.register(self.process.terminate)
+        self.process.start()
+        send.close()
+        return self
 
-    def __init__(self, manager, desc):
-        self.status_queue = manager.Queue()
+    def __run(self, send):
+        setproctitle.setproctitle(f"Backurne finisher ({self.cluster['name']})")
+        send.send(self())
+
+    def result(self):
+        try:
+            owned = self.pipe.recv()
+        except EOFError:
+            # Died: its backup images are expired with the others
+            owned = []
+        self.process.join()
+        return owned
+
+    def __call__(self):
+        if self.args.no_cleanup is True:
+            return []
+        if self.args.cluster is not None:
+            if self.cluster["name"] != self.args.cluster:
+                Log.debug(f"Skipping cluster {self.cluster['name']} due to --cluster")
+                return []
+
+        try:
+            return self.__work__()
+        except Exception as e:
+            # Its backup images are expired with the others, at the end
+            Log.warning(f"{e} thrown while expiring {self.cluster['name']}")
+            return []
+
+    def __work__(self):
+        name = self.cluster["name"]
+
+        # Our backup inventory was loaded before the transfers
+        inv = Ceph(None).inventory
+        if inv is not None:
+            for dest, snap in journal.transferred(name):
+                inv.add_snap(dest, snap)
+
+        Log.debug(f"Expire snapshots from live {self.cluster['type']}: {name}")
+        if self.cluster["type"] == "proxmox":
+            bidule = BackupProxmox(self.cluster, None, self.counters, self.args)
+        else:
+            bidule = BackupPlain(self.cluster, None, self.counters, self.args)
+        owned = bidule.expire_live()
+
+        if cleanup_backup(self.args):
+            Log.debug(f"Expiring our snapshots of {name}")
+            report = expire_backups(self.counters, owned)
+            report.log(f"the backup images of {name}")
+            journal.expired(report.removed)
+        return owned
+
+
+class Status_updater:
+    # Draws the counters of some phases, from a process of its own
+    # The main process stays single-threaded: it forks the workers
+    def __init__(self, counters, desc, phases, clusters=None):
+        self.counters = counters
         self.desc = desc
+        self.phases = phases
+        self.clusters = clusters
+        self.stop = multiprocessing.Event()
+
+        if config["log_level"] != "debug":
+            # progressbar uses signal.SIGWINCH
+            # It messes with multiprocessing, so we break it
+            real_signal = signal.signal
+            signal.signal = None
+            widget = [
+                progressbar.widgets.SimpleProgress(),
+                " ",
+                desc,
+                " (",
+                progressbar.widgets.Timer(),
+                ")",
+            ]
+            self.bar = progressbar.ProgressBar(maxval=1, widgets=widget)
+            signal.signal = real_signal
+
+    @handle_exc
+    def __call__(self):
+        Log.debug("Status_updater started")
+        if config["log_level"] != "debug":
+            self.bar.start()
+        while not self.stop.wait(1):
+            self.__update()
+        self.__update()
+        if config["log_level"] != "debug":
+            self.bar.finish()
+        Log.debug("Status_updater ended")
+
+    def __update(self):
+        values = self.counters.sum(self.phases, self.clusters)
+        msg = f"Backurne : {values['done']}/{values['total']} {self.desc}"
+        if values["bytes_done"] != 0:
+            done = humanize.naturalsize(values["bytes_done"], binary=True)
+            msg += f", {done}"
+            if values["bytes_total"] != 0:
+                total = humanize.naturalsize(values["bytes_total"], binary=True)
+                msg += f" of {total}"
+        setproctitle.setproctitle(msg)
+        if config["log_level"] != "debug":
+            self.bar.maxval = max(values["total"], 1)
+            self.bar.update(min(values["done"], self.bar.maxval))
 
     def __enter__(self):
-        target = Status_updater.Real_updater(self.status_queue, self.desc)
-        self.real_updater = multiprocessing.Process(target=target)
-        atexit.register(self.real_updater.terminate)
-        self.real_updater.start()
-        return self.status_queue
+        self.process = multiprocessing.Process(target=self, daemon=True)
+        self.process.start()
+        return self.counters
 
     def __exit__(self, type, value, traceback):
-        self.real_updater.terminate()
+        self.stop.set()
+        self.process.join()
         print("")
 
 
@@ -624,79 +880,102 @@ class Lock:
 class Producer:
     def __init__(self, params, args):
         self.cluster = params["cluster"]
-        self.regular_queue = params["regular_q"]
-        self.priority_queue = params["priority_q"]
-        self.status_queue = params["status_q"]
+        self.scheduler = params["scheduler"]
+        self.counters = params["counters"]
         self.args = args
 
     @handle_exc
     def __call__(self):
         Log.debug("Producer started")
         setproctitle.setproctitle("Backurne Producer")
-        self.__work__()
-        # We send one None per live_worker
-        # That way, all of them shall die
-        for i in range(0, config["live_worker"]):
-            try:
-                self.regular_queue.put(None)
-                self.priority_queue.put(None)
-            except Exception:
-                Log.error(
-                    "cannot end a live_worker! This is a critical bug, we will never die"
-                )
+        try:
+            self.__work__()
+        finally:
+            # Consumers exit once everything queued is done
+            self.scheduler.close()
 
         Log.debug("Producer ended")
 
-    @handle_exc
-    def __work__(self):
+    def backup(self):
         if self.args.cluster is not None:
             if self.cluster["name"] != self.args.cluster:
                 Log.debug(f"Skipping cluster {self.cluster['name']} due to --cluster")
-                return
+                return None
         Log.debug(f"Backuping {self.cluster['type']}: {self.cluster['name']}")
         if self.cluster["type"] == "proxmox":
-            bidule = BackupProxmox(
+            return BackupProxmox(
                 self.cluster,
-                self.regular_queue,
-                self.priority_queue,
-                self.status_queue,
+                self.scheduler,
+                self.counters,
                 self.args,
             )
-        else:
-            bidule = BackupPlain(
-                self.cluster,
-                self.regular_queue,
-                self.priority_queue,
-                self.status_queue,
-                self.args,
-            )
-        bidule.create_snaps()
+        return BackupPlain(
+            self.cluster,
+            self.scheduler,
+            self.counters,
+            self.args,
+        )
+
+    @handle_exc
+    def __work__(self):
+        bidule = self.backup()
+        if bidule is not None:
+            bidule.create_snaps()
 
 
 class Consumer:
     def __init__(self, params):
         self.id = params["id"]
         self.cluster = params["cluster"]
-        self.regular_queue = params["regular_q"]
-        self.priority_queue = params["priority_q"]
-        self.status_queue = params["status_q"]
-
-        # Track the queue status
-        # When both are dead, the worker can die in peace
-        self.priority_alive = True
-        self.regular_alive = True
+        self.scheduler = params["scheduler"]
+        self.counters = params["counters"]
 
     @handle_exc
     def __call__(self):
         Log.debug("Consumer started")
         setproctitle.setproctitle("Backurne Consumer")
+        # Producers rename backup images while we run: the inventory we
+        # inherited may be stale, ask the backup cluster instead
+        inventory.drop(Ceph(None).key)
         try:
-            lockname = f"Consumer-{self.cluster['name']}-{self.id}"
-            with Lock(lockname):
+            with self.lock():
                 self.__work__()
         except filelock.Timeout:
-            Log.debug(f"Cannot lock: {lockname}, another instance is running")
-        Log.debug("Consumer ended")
+            Log.debug(f"Cannot lock: {self.lockname()}, another instance is running")
+        Log.debug(f"Consumer ended, metadata cache: {cache.stats()}")
+
+    def lockname(self):
+        return f"Consumer-{self.cluster['name']}-{self.id}"
+
+    def lock(self):
+        return Lock(self.lockname())
+
+    def fetch(self, snaps):
+        name = self.cluster["name"]
+        done = 0
+        try:
+            with Lock(snaps[0]["dest"]):
+                for snap in snaps:
+                    setproctitle.setproctitle(
+                        f"Backurne: fetching {snap['backup'].source} ({snap['snap_name']})"
+                    )
+                    backup = snap["backup"]
+                    journal.update(
+                        snap["dest"], snap["snap_name"], journal.TRANSFERRING
+                    )
+                    size = backup.dl_snap(
+                        snap["snap_name"], snap["dest"], snap["last_snap"]
+                    )
+                    journal.update(snap["dest"], snap["snap_name"], journal.TRANSFERRED)
+                    done += 1
+                    self.counters.add(name, "transfer", done=1, bytes_done=size)
+        except filelock.Timeout:
+            pass
+        except Exception as e:
+            Log.error(e)
+        if done < len(snaps):
+            # Failed or skipped: done as well, yet nothing was transferred
+            self.counters.add(name, "transfer", done=len(snaps) - done)
 
     def __work__(self):
         while True:
@@ -704,49 +983,12 @@ class Consumer:
                 f"Backurne idle consumer ({self.cluster['name']})"
             )
 
-            if self.priority_alive is False and self.regular_alive is False:
+            # Blocks until there is some work, or none will ever come
+            snaps = self.scheduler.get()
+            if snaps is None:
                 break
 
-            snaps = []
-            if self.priority_alive is True:
-                try:
-                    snaps = self.priority_queue.get_nowait()
-                except queue.Empty:
-                    pass
-
-                if snaps is None:
-                    self.priority_alive = False
-                    continue
-
-            if len(snaps) == 0 and self.regular_alive is True:
-                try:
-                    snaps = self.regular_queue.get_nowait()
-                except queue.Empty:
-                    pass
-
-                if snaps is None:
-                    self.regular_alive = False
-                    continue
-
-            if len(snaps) == 0:
-                time.sleep(1)
-                continue
-
-            try:
-                with Lock(snaps[0]["dest"]):
-                    for snap in snaps:
-                        setproctitle.setproctitle(
-                            f"Backurne: fetching {snap['backup'].source} ({snap['snap_name']})"
-                        )
-                        backup = snap["backup"]
-                        backup.dl_snap(
-                            snap["snap_name"], snap["dest"], snap["last_snap"]
-                        )
-            except filelock.Timeout:
-                pass
-            except Exception as e:
-                Log.error(e)
-            self.status_queue.put("done_item")
+            self.fetch(snaps)
             setproctitle.setproctitle("Backurne idle consumer")
 
 
@@ -810,6 +1052,48 @@ def update_check_results(check_results):
             )
 
 
+def retention_plan(args):
+    if args.config is not None:
+        if not os.path.exists(args.config):
+            Log.error(f"{args.config} not found")
+            exit(1)
+        # Simulate with the candidate config, in place of ours
+        candidate = load_config(args.config)
+        config.clear()
+        config.update(candidate)
+
+    now = None
+    if args.at is not None:
+        now = snapshot.parse_date(args.at).timestamp()
+
+    simulation = retention.Simulation(sizes=not args.no_size)
+
+    data = []
+    for cluster in config["live_clusters"]:
+        if args.cluster is not None and cluster["name"] != args.cluster:
+            continue
+        if cluster["type"] == "proxmox":
+            items = CheckProxmox(cluster).snap_items()
+        else:
+            items = CheckPlain(cluster).snap_items()
+        for i in items:
+            i["cluster"] = cluster["name"]
+        data += items
+
+    backup = Ceph(None)
+    load_inventories([i["ceph"] for i in data] + [backup])
+
+    for i in data:
+        try:
+            simulation.live(i["cluster"], i["ceph"], i["image"], i["backup"].dest)
+        except Exception as e:
+            Log.warning(f"{e} thrown while simulating {i['image']}")
+
+    if args.cluster is None:
+        simulation.backup(backup, now)
+    return simulation.result()
+
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true")
@@ -822,13 +1106,25 @@ def get_args():
     back.add_argument("--force", action="store_true")
     back.add_argument("--no-cleanup", action="store_true")
     back.add_argument("--cleanup", action="store_true")
+    back.add_argument("--resume", action="store_true")
 
     sub.add_parser("precheck")
     sub.add_parser("check")
-    sub.add_parser("check-snap")
+    check_snap = sub.add_parser("check-snap")
+    check_snap.add_argument("--full", action="store_true")
     sub.add_parser("stats")
     sub.add_parser("version")
 
+    _progress = sub.add_parser("progress")
+    _progress.add_argument("--json", action="store_true")
+
+    plan = sub.add_parser("retention-plan")
+    plan.add_argument("--config", dest="config", nargs="?")
+    plan.add_argument("--at", dest="at", nargs="?")
+    plan.add_argument("--cluster", dest="cluster", nargs="?")
+    plan.add_argument("--no-size", action="store_true")
+    plan.add_argument("--json", action="store_true")
+
     ls = sub.add_parser("list-mapped")
     ls.add_argument("--json", action="store_true")
 
@@ -873,7 +1169,7 @@ def main():
             if args.action == "precheck":
                 ret = check.check()
             else:
-                ret = check.check_snap()
+                ret = check.check_snap(args.full)
             result += ret
 
         update_check_results(result)
@@ -883,84 +1179,87 @@ def main():
             Log.error("--vmid has no meaning without --cluster")
             exit(1)
 
-        manager = multiprocessing.Manager()
-        atexit.register(manager.shutdown)
+        journal.start()
+        interrupted = journal.interrupted()
+        if interrupted is not None and not args.resume:
+            when = datetime.datetime.fromtimestamp(interrupted)
+            Log.warning(
+                f"The run started at {when} was interrupted, "
+                "use --resume to transfer what it left behind"
+            )
 
-        live_workers = []
+        clusters = config["live_clusters"]
+        names = [i["name"] for i in clusters]
+        status = counters.Counters(names + [None])
+        atexit.register(status.close)
 
-        with Status_updater(manager, "images processed") as status_queue:
-            for cluster in config["live_clusters"]:
+        if args.vmid is None:
+            # Listed once, inherited by every worker
+            Ceph(None).load_inventory()
+
+        # Each cluster is cleaned up as soon as its transfers are done, while
+        # the others are still running
+        with Status_updater(status, "images processed", counters.PHASES):
+            manager = scheduler.Manager()
+            manager.start()
+            atexit.register(manager.shutdown)
+
+            running = {}
+            for cluster in clusters:
                 params = {
                     "cluster": cluster,
-                    "regular_q": manager.Queue(),
-                    "priority_q": manager.Queue(),
-                    "status_q": status_queue,
+                    "scheduler": manager.Scheduler(),
+                    "counters": status,
                 }
 
                 producer = multiprocessing.Process(target=Producer(params, args))
                 atexit.register(producer.terminate)
                 producer.start()
 
+                # Workers exit once their scheduler is closed and drained
+                # When all of them are done, the cluster is done
+                workers = []
                 for i in range(0, config["live_worker"]):
                     params["id"] = i
                     pid = multiprocessing.Process(target=Consumer(params))
                     atexit.register(pid.terminate)
-                    live_workers.append(pid)
+                    workers.append(pid)
                     pid.start()
+                running[cluster["name"]] = (cluster, workers)
 
-            # Workers will exit upon a None reception
-            # When all of them are done, we are done
-            for pid in live_workers:
-                pid.join()
+            finishers = []
+            while True:
+                for name, (cluster, workers) in list(running.items()):
+                    if any(i.is_alive() for i in workers):
+                        continue
+                    del running[name]
+                    finishers.append(Finisher(cluster, status, args).start())
+                if len(running) == 0:
+                    break
+                sentinels = [i.sentinel for _, w in running.values() for i in w]
+                multiprocessing.connection.wait(sentinels)
+
+            owned = [i.result() for i in finishers]
 
         if args.no_cleanup is True:
             Log.debug("not cleaning up as --no-cleanup is used")
+            journal.finish()
             exit(0)
 
-        with Status_updater(
-            manager, "images cleaned up on live clusters"
-        ) as status_queue:
-            for cluster in config["live_clusters"]:
-                if args.cluster is not None:
-                    if cluster["name"] != args.cluster:
-                        Log.debug(
-                            f"Skipping cluster {cluster['name']} due to --cluster"
-                        )
-                        continue
-
-                Log.debug(
-                    f"Expire snapshots from live {cluster['type']}: {cluster['name']}"
-                )
-                if cluster["type"] == "proxmox":
-                    bidule = BackupProxmox(cluster, None, None, status_queue, args)
-                else:
-                    bidule = BackupPlain(cluster, None, None, status_queue, args)
-                bidule.expire_live()
-
-        if (
-            args.cleanup
-            or args.cluster is None
-            and args.profile is None
-            and args.vmid is None
-        ):
+        if cleanup_backup(args):
+            # What no live cluster owns: removed disks, VMs or clusters
             Log.debug("Expiring our snapshots")
-            # Dummy Ceph object used to retrieve the real backup Object
-            ceph = Ceph(None)
-
+            skip = set()
+            for i in owned:
+                skip.update(i)
             with Status_updater(
-                manager, "images cleaned up on backup cluster"
-            ) as status_queue:
-                data = []
-                for i in ceph.ls():
-                    data.append(
-                        {"ceph": ceph, "image": i, "status_queue": status_queue}
-                    )
-                    status_queue.put("add_item")
-                with multiprocessing.Pool(config["backup_worker"]) as pool:
-                    for i in pool.imap_unordered(Backup.expire_backup, data):
-                        pass
+                status, "images cleaned up on backup cluster", ("expire",), [None]
+            ):
+                report = expire_backups(status, skip=skip)
+            report.log("the backup cluster")
+            journal.expired(report.removed)
 
-        manager.shutdown()
+        journal.finish()
     elif args.action == "ls":
         restore = Restore(args.rbd, None)
         data = restore.ls()
@@ -981,6 +1280,91 @@ def main():
             print(json.dumps(data, default=str))
         else:
             print(pt)
+    elif args.action == "progress":
+        data = progress.read()
+        if args.json is True:
+            print(json.dumps(data))
+        else:
+            pt = pretty.Pt(
+                ["Image", "Destination", "Transferred", "Rate", "Done", "ETA"]
+            )
+            for i in data:
+                done = f"{i['percent']}%" if i["percent"] is not None else "-"
+                eta = "-"
+                if i["eta"] is not None:
+                    eta = humanize.naturaldelta(datetime.timedelta(seconds=i["eta"]))
+                row = [
+                    i["image"],
+                    i["dest"],
+                    humanize.naturalsize(i["bytes"], binary=True),
+                    f"{humanize.naturalsize(i['rate'], binary=True)}/s",
+                    done,
+                    eta,
+                ]
+                pt.add_row(row)
+            print(pt)
+
+            for run in counters.read():
+                print(f"Backup run {run['pid']}:")
+                pt = pretty.Pt(["Cluster", "Phase", "Items", "Transferred"])
+                for i in run["clusters"]:
+                    cluster = i["cluster"] if i["cluster"] is not None else "backup"
+                    for phase, values in i["phases"].items():
+                        if values["total"] == 0:
+                            continue
+                        size = "-"
+                        if values["bytes_done"] != 0 or values["bytes_total"] != 0:
+                            size = humanize.naturalsize(
+                                values["bytes_done"], binary=True
+                            )
+                            if values["bytes_total"] != 0:
+                                total = humanize.naturalsize(
+                                    values["bytes_total"], binary=True
+                                )
+                                size += f" / {total}"
+                        items = f"{values['done']} / {values['total']}"
+                        pt.add_row([cluster, phase, items, size])
+                print(pt)
+                lookups = [
+                    f"{kind}: {i['hits']} hits, {i['misses']} misses"
+                    for kind, i in run["cache"].items()
+                    if i["hits"] != 0 or i["misses"] != 0
+                ]
+                if len(lookups) != 0:
+                    print(f"Metadata cache: {'; '.join(lookups)}")
+    elif args.action == "retention-plan":
+        data = retention_plan(args)
+        if args.json is True:
+            print(json.dumps(data))
+        else:
+
+            def size(value):
+                if value is None:
+                    return "-"
+                return humanize.naturalsize(value, binary=True)
+
+            pt = pretty.Pt(["Cluster", "Image", "Snapshots", "Image removed", "Freed"])
+            for i in data["images"]:
+                cluster = i["cluster"] if i["cluster"] is not None else "backup"
+                rm = "yes" if i["rm"] else "no"
+                pt.add_row([cluster, i["image"], len(i["snaps"]), rm, size(i["freed"])])
+            print(pt)
+
+            pt = pretty.Pt(
+                ["Cluster", "Snapshots", "Expired", "Protected", "Images", "Freed"]
+            )
+            for i in data["clusters"]:
+                cluster = i["cluster"] if i["cluster"] is not None else "backup"
+                row = [
+                    cluster,
+                    i["total"],
+                    i["snaps"],
+                    i["protected"],
+                    i["images"],
+                    size(i["freed"]),
+                ]
+                pt.add_row(row)
+            print(pt)
     elif args.action == "list-mapped":
         data = get_mapped(extended=False)
         if args.json is True:
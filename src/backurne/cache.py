@@ -0,0 +1,83 @@
+import collections
+import os
+import time
+
+from .config import config
+
+
+# The kinds of lookup, see Ceph
+KINDS = ("exists", "info", "ls", "snap")
+
+# Hits and misses of every cache of this process, by kind of lookup
+counters = collections.defaultdict(lambda: {"hits": 0, "misses": 0})
+
+# What take() already returned
+published = {}
+
+
+def stats():
+    return {kind: dict(value) for kind, value in counters.items()}
+
+
+def take():
+    # Hits and misses since the last call
+    global published
+    result = {}
+    for kind, value in counters.items():
+        done = published.get(kind, {"hits": 0, "misses": 0})
+        delta = {i: value[i] - done[i] for i in value if value[i] != done[i]}
+        if len(delta) != 0:
+            result[kind] = delta
+    published = stats()
+    return result
+
+
+def forked():
+    # Forked workers only report their own lookups
+    global published
+    published = stats()
+
+
+os.register_at_fork(after_in_child=forked)
+
+
+class Cache:
+    # Metadata lookups of a Ceph object, bounded in size and time
+    # Keys are (kind, image, ..): entries are dropped per image when the
+    # image is modified
+    def __init__(self):
+        self.size = config["metadata_cache"]["size"]
+        self.ttl = config["metadata_cache"]["ttl"]
+        self.entries = collections.OrderedDict()
+        self.by_image = collections.defaultdict(set)
+
+    def get(self, key, fetch):
+        if self.size == 0 or self.ttl == 0:
+            return fetch()
+
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            counters[key[0]]["hits"] += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        counters[key[0]]["misses"] += 1
+        value = fetch()
+        self.entries[key] = (now + self.ttl, value)
+        self.entries.move_to_end(key)
+        self.by_image[key[1]].add(key)
+        while len(self.entries) > self.size:
+            old, _ = self.entries.popitem(last=False)
+            self.by_image[old[1]].discard(old)
+        return value
+
+    def invalidate(self, image):
+        # Lookups of this image, and listings of the pool
+        for image in (image, None):
+            for key in self.by_image.pop(image, ()):
+                self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.by_image.clear()
@@ -0,0 +1,56 @@
+from .log import log as Log
+
+
+# Catalogs are stored per process, like inventories (see inventory.py)
+catalogs = {}
+
+
+def parse(image):
+    # Backup images are named ident;disk;comment
+    split = image.split(";")
+    if len(split) != 3:
+        return None
+    return split
+
+
+class Catalog:
+    # The backup images, indexed by (ident, disk)
+    def __init__(self, images):
+        self.by_disk = {}
+        for image in images:
+            self.add(image)
+
+    def __len__(self):
+        return sum(len(i) for i in self.by_disk.values())
+
+    def add(self, image):
+        split = parse(image)
+        if split is None:
+            return
+        ident, disk, _ = split
+        self.by_disk.setdefault((ident, disk), set()).add(image)
+
+    def rm(self, image):
+        split = parse(image)
+        if split is None:
+            return
+        ident, disk, _ = split
+        self.by_disk.get((ident, disk), set()).discard(image)
+
+    def rename(self, image, dest):
+        self.rm(image)
+        self.add(dest)
+
+    def find(self, ident, disk):
+        return sorted(self.by_disk.get((ident, disk), ()))
+
+
+def get(key):
+    return catalogs.get(key)
+
+
+def register(key, images):
+    catalog = Catalog(images)
+    catalogs[key] = catalog
+    Log.debug(f"Catalog loaded for {key}: {len(catalog)} images")
+    return catalog
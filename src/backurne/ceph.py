@@ -1,47 +1,115 @@
+import concurrent.futures
 import datetime
 import json
-import re
-import threading
-import time
+import math
+import shlex
 from subprocess import DEVNULL
 from subprocess import PIPE
 from subprocess import Popen
+from subprocess import TimeoutExpired
 
-import dateutil.parser
-import setproctitle
 import sh
 
+from . import catalog
+from . import compress
+from . import estimate
+from . import inventory
+from . import manifest
+from . import slots
+from . import snapshot
+from .backend import Error as BackendError
+from .backend import get_backend
+from .cache import Cache
 from .config import config
+from .extents import export_cmd as extents_export_cmd
+from .extents import header as extents_header
+from .extents import python_cmd as extents_python_cmd
+from .extents import split as extents_split
 from .log import log as Log
 from .log import report_time
+from .progress import Progress
+from .shaping import get_shaper
+from .ssh import get_pool
+from .state import Checkpoint
+from .transfer import Result as TransferResult
+from .transfer import Transfer
+from .transfer import TransferError
 
 
 class Ceph:
-    def __init__(self, pool, namespace=None, endpoint=None, cluster_conf={}):
+    def __init__(
+        self,
+        pool,
+        namespace=None,
+        endpoint=None,
+        cluster_conf={},
+        compression=None,
+        name=None,
+    ):
         self.endpoint = endpoint
         self.cluster = cluster_conf
-        self.compress = config["download_compression"]
+        self.name = name if name is not None else cluster_conf.get("name")
+        self.namespace = namespace
 
         if pool is None:
-            pool = config["backup_cluster"]["pool"]
-            self.pool = pool
-            self.cmd = sh.Command("rbd").bake("-p", pool)
+            self.is_backup = True
+            self.pool = config["backup_cluster"]["pool"]
+            self.helper = None
+            self.control = None
             self.esc = False
         else:
+            self.is_backup = False
             self.backup = Ceph(None)
             self.pool = pool
 
             self.__get_helper__()
-            self.cmd = self.helper.bake("rbd", "-p", pool)
-        if namespace is not None:
-            self.namespace = namespace
-            self.cmd = self.cmd.bake("--namespace", namespace)
+
+        if compression is None:
+            compression = cluster_conf.get("compression")
+        # download_compression was never supported through helpers
+        self.compression = compress.settings(compression, legacy=self.esc)
+
+        self.__bake()
+        self.backend = get_backend(self)
+        self.cache = Cache()
+
+    def __bake(self):
+        self.rbd_args = ["rbd", "-p", self.pool]
+        if self.namespace is not None:
+            self.rbd_args += ["--namespace", self.namespace]
+
+        if self.helper is None:
+            self.cmd = sh.Command("rbd").bake(*self.rbd_args[1:])
+        else:
+            self.cmd = self.helper.bake(*self.rbd_args)
 
         self.json = self.cmd.bake("--format", "json")
 
+    def __getstate__(self):
+        # Commands are baked again by __setstate__
+        state = self.__dict__.copy()
+        del state["cmd"]
+        del state["json"]
+        if self.endpoint is not None:
+            del state["helper"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Another process may have changed things since
+        self.cache.clear()
+        if not self.is_backup and self.endpoint is not None:
+            # We have been sent to another process: pick its own
+            # master connection
+            self.__get_helper__()
+        self.__bake()
+
     def __get_helper__(self):
+        self.control = None
         if self.endpoint is not None:
-            self.helper = sh.Command("ssh").bake("-n", self.endpoint)
+            pool = get_pool(self.endpoint)
+            self.control = pool.control_path()
+            self.helper = pool.command(self.control)
             self.esc = True
             return
 
@@ -62,18 +130,54 @@ class Ceph:
         ]
         self.helper = sh.Command(use_helper_cmd).bake(*use_helper_args)
         self.esc = False
-        self.compress = False
 
     def __str__(self):
         result = f"pool {self.pool} using config {self.cluster}"
         return result
 
     def __call__(self, *args):
+        self.ready()
         return self.cmd(args)
 
-    def __fetch(self, *args):
-        result = self.json(args)
-        result = json.loads(result.stdout.decode("utf-8"))
+    def ready(self):
+        # Checks the ssh master connection, if any, before using it
+        if self.control is not None:
+            get_pool(self.endpoint).ready(self.control)
+
+    @property
+    def key(self):
+        if self.is_backup:
+            return f"backup:{self.pool}:{self.namespace}"
+        endpoint = self.endpoint
+        if endpoint is None:
+            endpoint = self.cluster.get("name")
+        return f"{endpoint}:{self.pool}:{self.namespace}"
+
+    @property
+    def inventory(self):
+        return inventory.get(self.key)
+
+    @property
+    def catalog(self):
+        # Built once per run, then kept up to date by ourselves
+        result = catalog.get(self.key)
+        if result is None:
+            result = catalog.register(self.key, self.ls())
+        return result
+
+    def load_inventory(self):
+        # Fetch every image, snapshot and protection flag in a single pass
+        try:
+            entries = self.backend.entries()
+        except BackendError as e:
+            # Some images could not be opened: a partial inventory would
+            # lie about them, so we stick with per-image lookups
+            inventory.drop(self.key)
+            Log.warning(f"Cannot load inventory for {self}: {e}")
+            return None
+        result = inventory.register(self.key, entries)
+        if self.is_backup:
+            catalog.register(self.key, result.ls())
         return result
 
     def __esc(self, snap):
@@ -83,31 +187,52 @@ class Ceph:
             return snap
 
     def info(self, image):
-        return self.__fetch("info", image)
+        spec = image.split("@", 1)
+        key = ("info", spec[0], image)
+        return dict(self.cache.get(key, lambda: self.backend.info(image)))
 
     def ls(self):
-        return self.__fetch("ls")
+        inv = self.inventory
+        if inv is not None:
+            return inv.ls()
+        return list(self.cache.get(("ls", None), self.backend.ls))
 
-    def du(self, image):
-        return self.__fetch("du", image)
+    def du(self, image=None):
+        return self.backend.du(image)
 
     def snap(self, image):
-        snap = self.__fetch("snap", "ls", image)
-        snap = [i["name"] for i in snap]
+        inv = self.inventory
+        if inv is not None:
+            snap = inv.snap(image)
+        else:
+            snap = self.cache.get(("snap", image), lambda: self.backend.snaps(image))
         snap = [i for i in snap if i.startswith(config["snap_prefix"])]
         return snap
 
+    def is_protected(self, extsnap):
+        image, snap = extsnap.split("@", 1)
+        inv = self.inventory
+        if inv is not None:
+            return inv.protected(image, snap)
+        return self.info(extsnap)["protected"] == "true"
+
     def protect(self, extsnap):
-        info = self.info(extsnap)
-        if info["protected"] == "true":
+        if self.is_protected(extsnap):
             return
-        self("snap", "protect", extsnap)
+        image, snap = extsnap.split("@", 1)
+        self.backend.protect(image, snap)
+        self.cache.invalidate(image)
+        if self.inventory is not None:
+            self.inventory.set_protected(image, snap, True)
 
     def unprotect(self, extsnap):
-        info = self.info(extsnap)
-        if info["protected"] == "false":
+        if not self.is_protected(extsnap):
             return
-        self("snap", "unprotect", extsnap)
+        image, snap = extsnap.split("@", 1)
+        self.backend.unprotect(image, snap)
+        self.cache.invalidate(image)
+        if self.inventory is not None:
+            self.inventory.set_protected(image, snap, False)
 
     def clone(self, extsnap):
         for i in range(1, 100):
@@ -115,11 +240,18 @@ class Ceph:
             if not self.exists(clone):
                 break
         self("clone", extsnap, f"{self.pool}/{clone}")
+        self.cache.invalidate(clone)
+        if self.inventory is not None:
+            self.inventory.add(clone)
         return clone
 
     def map(self, image):
         # lazy import to avoid circular imports
+        from .disk import DeviceTimeout
         from .disk import get_rbd_mapped
+        from .disk import read_line
+        from .disk import wait_for
+        from .disk import wait_nbd
 
         if self.esc is True:
             Log.error("BUG: cannot map via ssh")
@@ -128,125 +260,338 @@ class Ceph:
         cmd = ["device", "-t", "nbd", "map", image]
         cmd = str(self.cmd).split(" ") + cmd
 
-        Popen(cmd, stdout=DEVNULL, stderr=DEVNULL)
+        # rbd-nbd prints the device once it is attached, then daemonizes
+        # Its daemon may keep our pipe open: do not wait for EOF
+        p = Popen(cmd, stdout=PIPE, stderr=DEVNULL)
+        try:
+            dev = read_line(p.stdout, f"rbd-nbd to map {image}")
+        except DeviceTimeout as e:
+            p.kill()
+            p.wait()
+            Log.error(f"Cannot map {image}: {e}")
+            return None
+        finally:
+            p.stdout.close()
+        try:
+            rc = p.wait(timeout=config["device_timeout"])
+        except TimeoutExpired:
+            rc = None
+        if rc not in (0, None):
+            Log.error(f"Cannot map {image}: rbd exited with code {rc}")
+            return None
+
+        def find():
+            for mapped in get_rbd_mapped():
+                if mapped.image == image:
+                    return mapped.dev
 
-        # Should be enough .. right ?
-        time.sleep(1)
-        for mapped in get_rbd_mapped():
-            if mapped.image == image:
-                return mapped.dev
+        try:
+            if not dev.startswith("/dev/"):
+                wait_for(lambda: find() is not None, f"{image} to be mapped")
+                dev = find()
+            wait_nbd(dev)
+        except DeviceTimeout as e:
+            Log.error(f"Cannot map {image}: {e}")
+            return None
+        return dev
 
     def unmap(self, dev):
+        # lazy import to avoid circular imports
+        from .disk import DeviceTimeout
+        from .disk import wait_nbd
+
         if self.esc is True:
             Log.error("BUG: cannot unmap via ssh")
             exit(1)
 
         self.cmd("device", "-t", "nbd", "unmap", dev)
 
-        # Wait a bit to make sure the dev is effectively gone
-        time.sleep(1)
+        # Make sure the dev is effectively gone
+        try:
+            wait_nbd(dev, connected=False)
+        except DeviceTimeout as e:
+            Log.warning(f"{dev} may still be in use: {e}")
 
     def rm(self, image):
         Log.debug(f"Deleting image {image} ..")
         try:
-            self("rm", image)
-        except sh.ErrorReturnCode:
+            self.backend.rm(image)
+        except BackendError:
             Log.debug(f"{image} cannot be removed, maybe someone mapped it")
+            return False
+        finally:
+            self.cache.invalidate(image)
+        if self.inventory is not None:
+            self.inventory.rm(image)
+        if catalog.get(self.key) is not None:
+            self.catalog.rm(image)
+        return True
+
+    def create(self, image, size=1 << 20):
+        self.backend.create(image, size)
+        self.cache.invalidate(image)
+        if self.inventory is not None:
+            self.inventory.add(image, size)
+        if catalog.get(self.key) is not None:
+            self.catalog.add(image)
 
     def rm_snap(self, image, snap):
         Log.debug(f"Deleting snapshot {image}@{snap} .. ")
-        snap = self.__esc(snap)
         try:
-            self("snap", "rm", "--snap", snap, image)
-        except sh.ErrorReturnCode:
+            self.backend.snap_rm(image, snap)
+        except BackendError:
             Log.debug(f"Cannot rm {image}@{snap}, may be held by something")
+            return False
+        finally:
+            self.cache.invalidate(image)
+        if self.inventory is not None:
+            self.inventory.rm_snap(image, snap)
+        return True
+
+    def purge_snaps(self, image):
+        # Every snapshot of the image, in one go
+        Log.debug(f"Purging snapshots of {image} .. ")
+        try:
+            self.backend.snap_purge(image)
+        except BackendError:
+            Log.debug(f"Cannot purge {image}, some snapshot may be held")
+            return False
+        finally:
+            self.cache.invalidate(image)
+        if self.inventory is not None:
+            for snap in self.inventory.snap(image):
+                self.inventory.rm_snap(image, snap)
+        return True
 
     def mk_snap(self, image, snap, vm=None):
-        snap = self.__esc(snap)
-
         Log.debug(f"Creating snapshot {image}@{snap} .. ")
 
-        if vm is None:
-            self("snap", "create", "--snap", snap, image)
-            return
-
-        self("snap", "create", "--snap", snap, image)
+        self.backend.snap_create(image, snap)
+        self.cache.invalidate(image)
+        if self.inventory is not None:
+            self.inventory.add_snap(image, snap)
 
     def exists(self, image):
-        try:
-            self.cmd("info", image)
-            return True
-        except sh.ErrorReturnCode:
-            return False
-
-    def enqueue_output(self, out):
-        original = setproctitle.getproctitle()
-
-        regexp = re.compile(r"\w* \w*: (.*)%")
-        line = ""
-        for char in iter(lambda: out.read(1), b""):
-            char = char.decode("utf-8")
-            if ord(char) != 13:
-                line += char
-                continue
-
-            if line == "":
-                continue
+        inv = self.inventory
+        if inv is not None:
+            return inv.exists(image)
+        return self.cache.get(("exists", image), lambda: self.backend.exists(image))
+
+    def __on_data(self, tracker):
+        shaper = get_shaper(self.name, self.endpoint)
+        if shaper is None:
+            return tracker.on_data
+
+        def on_data(size):
+            tracker.on_data(size)
+            shaper(size)
+
+        return on_data
+
+    def remote(self, args, pipe=None):
+        # Build a command run on the live cluster
+        # Through ssh, it is handed to a shell and must be quoted
+        # Through a helper, it is executed as-is
+        quote = shlex.quote if self.esc is True else str
+        self.ready()
+        if pipe is None:
+            return str(self.helper).split(" ") + [quote(i) for i in args]
+
+        # bash's pipefail makes the exit code reflect any failure in the
+        # pipeline, not only the last command's
+        # A pipe given as a string is shell code already
+        if not isinstance(pipe, str):
+            pipe = " ".join(shlex.quote(i) for i in pipe)
+        inner = " ".join(shlex.quote(i) for i in args) + " | " + pipe
+        return str(self.helper).split(" ") + [
+            "bash",
+            "-o",
+            "pipefail",
+            "-c",
+            quote(inner),
+        ]
 
-            progress = regexp.match(line)
-            if progress is not None:
-                progress = f"{progress.group(1)}% complete"
-            else:
-                progress = line
-            setproctitle.setproctitle(f"{original} ({progress})")
-            line = ""
-        out.close()
+    def diff(self, image, snap, last_snap=None):
+        args = ["diff", "--whole-object", f"{image}@{snap}"]
+        if last_snap is not None:
+            args += ["--from-snap", last_snap]
+        cmd = self.remote(self.rbd_args + ["--format", "json"] + args)
+        result = sh.Command(cmd[0])(*cmd[1:])
+        return json.loads(result.stdout.decode("utf-8"))
+
+    def __import_cmd(self, dest, comp):
+        imp = str(self.backup.cmd).split(" ") + [
+            "import-diff",
+            "--no-progress",
+            "-",
+            dest,
+        ]
+        if comp["codec"] is not None:
+            return [compress.decompress_cmd(comp), imp]
+        return [imp]
+
+    def __export_cmd(self, args, comp, level):
+        if comp["codec"] is not None:
+            return self.remote(args, pipe=compress.timed_cmd(comp, level))
+        return self.remote(args)
+
+    def __record(self, comp, image, dest, snap, level, result):
+        report_time(image, self.endpoint, result.duration, result.bytes)
+        Log.debug(f"Transfer to {dest}: {result}")
+        estimate.record_actual(dest, snap, result.raw_bytes)
+        if comp["codec"] is not None:
+            compress.record(
+                comp, dest, level, result.raw_bytes, result.bytes, result.compress_cpu
+            )
 
-    def do_backup(self, image, snap, dest, last_snap=None):
-        # On this function, we burden ourselves with Popen
-        # I have not figured out how do fast data transfer
-        # between processes with python3-sh
-        snap = self.__esc(snap)
-        export = ["export-diff", image, "--snap", snap]
-        export = str(self.cmd).split(" ") + export
-        if last_snap is None:
-            export += [
-                "-",
-            ]
+    def __transfer_extents(
+        self, image, snap, dest, last_snap, size, comp, level, tracker
+    ):
+        conf = config["extent_transfer"]
+        checkpoint = Checkpoint(dest, snap, last_snap)
+
+        ranges = checkpoint.pending()
+        if ranges is None:
+            extents = self.diff(image, snap, last_snap)
+            # Ranges are kept small enough, so that an interrupted transfer
+            # does not lose much
+            total = sum(i["length"] for i in extents)
+            count = max(conf["streams"], math.ceil(total / conf["chunk"]))
+            if comp["codec"] is None:
+                # Otherwise, we only see compressed bytes
+                tracker.total = total
+            ranges = extents_split(extents, count, size)
+            checkpoint.start(ranges)
+            Log.debug(f"Transferring {image}@{snap} in {len(ranges)} ranges")
+        elif len(ranges) == 0:
+            # Interrupted right before the barrier: every range is applied
+            Log.info(f"Resuming {image}@{snap}: creating the snapshot")
+            result = TransferResult()
+            result.end = result.start
+            self.backup.mk_snap(dest, snap)
+            checkpoint.drop()
+            return result
         else:
-            last_snap = self.__esc(last_snap)
-            export += ["--from-snap", last_snap, "-"]
+            Log.info(f"Resuming {image}@{snap}: {len(ranges)} ranges left")
+
+        # Check the base snapshot, and resize the destination once,
+        # before the streams race each other
+        header = extents_header(size, last_snap)
+        imp = str(self.backup.cmd).split(" ") + ["import-diff", "--no-progress"]
+        sh.Command(imp[0])(*imp[1:], "-", dest, _in=header)
+
+        transfers = {}
+        stderrs = []
+        for start, end in ranges:
+            export = extents_export_cmd(
+                self.pool, self.namespace, image, snap, last_snap, start, end
+            )
+            export = self.__export_cmd(export, comp, level)
+            on_stderr = None
+            if comp["codec"] is not None:
+                on_stderr = compress.Stderr()
+                stderrs.append(on_stderr)
+            transfers[(start, end)] = Transfer(
+                export,
+                self.__import_cmd(dest, comp),
+                on_stderr=on_stderr,
+                on_data=self.__on_data(tracker),
+            )
 
-        if self.compress is True:
-            export += ["|", "zstd"]
-            imp = f'zstdcat | {self.backup.cmd} import-diff --no-progress - "{dest}"'
-        else:
-            imp = f'{self.backup.cmd} import-diff --no-progress - "{dest}"'
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(conf["streams"]) as executor:
+            futures = {executor.submit(v): k for k, v in transfers.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                    checkpoint.done(futures[future])
+                except concurrent.futures.CancelledError:
+                    pass
+                except TransferError as e:
+                    if failure is None:
+                        failure = e
+                        # The snapshot cannot be created anyway: stop here
+                        # The next run will resume from the checkpoint
+                        for i in futures:
+                            i.cancel()
+                        for i in transfers.values():
+                            i.kill()
+
+        result = TransferResult()
+        result.start = min(i.result.start for i in transfers.values())
+        result.end = datetime.datetime.now()
+        result.bytes = sum(i.result.bytes for i in transfers.values())
+        result.raw_bytes = sum(i.result.raw_bytes for i in transfers.values())
+        cpu = [i.seconds for i in stderrs]
+        if len(cpu) != 0 and None not in cpu:
+            result.compress_cpu = sum(cpu)
+        if failure is not None:
+            raise TransferError(f"{image}@{snap} to {dest}: {failure}")
+
+        # Barrier: every range is applied, the snapshot can be created
+        self.backup.mk_snap(dest, snap)
+        checkpoint.drop()
+        return result
 
-        start = datetime.datetime.now()
+    def do_backup(self, image, snap, dest, last_snap=None):
+        comp = compress.for_image(self.compression, image)
+        level = None
+        if comp["codec"] is not None:
+            level = compress.pick_level(comp, dest)
 
-        p1 = Popen(export, stdout=PIPE, stderr=PIPE, bufsize=0)
+        tracker = Progress(image, dest, self.endpoint)
+        try:
+            with slots.acquire(self.name, self.endpoint):
+                result = self.__do_backup(
+                    image, snap, dest, last_snap, comp, level, tracker
+                )
+        finally:
+            tracker.close()
+        # Uncompressed bytes transferred
+        return result.raw_bytes
+
+    def __do_backup(self, image, snap, dest, last_snap, comp, level, tracker):
+        threshold = config["extent_transfer"]["threshold"]
+        resume = Checkpoint(dest, snap, last_snap).pending() is not None
+        if threshold is not None or resume:
+            size = self.info(f"{image}@{snap}")["size"]
+            if resume or size >= threshold:
+                result = self.__transfer_extents(
+                    image, snap, dest, last_snap, size, comp, level, tracker
+                )
+                self.__record(comp, image, dest, snap, level, result)
+                return result
+
+        export = self.rbd_args + ["export-diff", image, "--snap", snap]
+        if last_snap is not None:
+            export += ["--from-snap", last_snap]
+        export += ["-"]
+        export = self.__export_cmd(export, comp, level)
+
+        # The compressor reports its CPU time after rbd's progress
+        stderr = compress.Stderr(tracker.feed)
+        transfer = Transfer(
+            export,
+            self.__import_cmd(dest, comp),
+            on_stderr=stderr,
+            on_data=self.__on_data(tracker),
+        )
+        try:
+            result = transfer()
+        except TransferError as e:
+            raise TransferError(f"{image}@{snap} to {dest}: {e}")
+        result.compress_cpu = stderr.seconds
 
-        p2 = Popen(imp, stdin=p1.stdout, shell=True)
-        t = threading.Thread(target=self.enqueue_output, args=(p1.stderr,))
-        t.start()
+        self.__record(comp, image, dest, snap, level, result)
 
-        p1.stdout.close()
-        p2.communicate()
-        t.join()
-        end = datetime.datetime.now()
-        report_time(image, self.endpoint, end - start)
+        self.backup.cache.invalidate(dest)
+        if self.backup.inventory is not None:
+            # import-diff created the snapshot on the backup image
+            self.backup.inventory.add_snap(dest, snap)
+        return result
 
     def get_last_snap(self, snaps):
-        last_date = datetime.datetime.fromtimestamp(0)
-        last = None
-        for snap in snaps:
-            split = snap.split(";")
-            date = dateutil.parser.parse(split[3])
-            if date > last_date:
-                last_date = date
-                last = snap
-        return last
+        return snapshot.last(snaps)
 
     def get_last_shared_snap(self, image, dest):
         live_snaps = self.snap(image)
@@ -256,41 +601,38 @@ class Ceph:
         return self.get_last_snap(inter)
 
     def update_desc(self, source, dest):
-        split = dest.split(";")
+        ident, disk, _ = dest.split(";")
         found = False
-        for i in self.ls():
-            snap = i.split(";")
-            if snap[0] != split[0] or snap[1] != split[1]:
-                continue
-
-            if snap[2] == split[2]:
+        for i in self.catalog.find(ident, disk):
+            if i == dest:
                 # This is my image, nothing to do
                 continue
 
             if found is True:
                 Log.error(f"{i} matches {dest}, but we already found a match")
             found = True
-            self("mv", i, dest)
-
-    def checksum(self, image, snap):
-        snap = self.__esc(snap)
-        cmd = ["export", image, "--snap", snap, "-"]
-        cmd = str(self.cmd).split(" ") + cmd
-
-        if self.esc is True:
-            # via ssh
-            cmd += ["|", config["hash_binary"]]
-            p1 = Popen(cmd, stdout=PIPE, stderr=DEVNULL)
-        else:
-            p2 = Popen(cmd, stdout=PIPE, stderr=DEVNULL)
-            p1 = Popen(
-                [
-                    config["hash_binary"],
-                ],
-                stdin=p2.stdout,
-                stdout=PIPE,
-                stderr=DEVNULL,
-            )
-        out = p1.communicate()[0]
-        out = out.decode("utf-8").split(" ")[0]
-        return out
+            self.backend.rename(i, dest)
+            self.cache.invalidate(i)
+            self.cache.invalidate(dest)
+            if self.inventory is not None:
+                self.inventory.rename(i, dest)
+            self.catalog.rename(i, dest)
+
+    def hash_chunks(self, image, snap, from_snap=None, from_size=0):
+        args = extents_python_cmd(manifest.HASH_SCRIPT) + [
+            self.pool,
+            self.namespace or "",
+            image,
+            snap,
+            from_snap or "",
+            str(from_size),
+            str(manifest.CHUNK),
+        ]
+        if not self.is_backup:
+            args = self.remote(args)
+        p = Popen(args, stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            err = err.decode("utf-8").rstrip()
+            raise BackendError(f"Cannot hash {image}@{snap} on {self}: {err}")
+        return manifest.parse(out)
@@ -0,0 +1,147 @@
+import copy
+import re
+import shlex
+
+from . import state
+from .config import config
+from .log import log as Log
+
+
+# Printed on stderr by the compress stage, right before its CPU time
+MARK = b"backurne-compressor-times"
+# bash's times: "0m1.250s 0m0.030s", user and system
+TIMES = re.compile(rb"(\d+)m([\d.]+)s")
+
+
+def settings(overrides=None, legacy=True):
+    # Global settings, overridden by the cluster's
+    result = copy.deepcopy(config["compression"])
+    if result["codec"] is None and legacy and config["download_compression"]:
+        result["codec"] = "zstd"
+    for key, value in (overrides or {}).items():
+        result[key] = value
+    return result
+
+
+def for_image(conf, image):
+    # Per-image overrides come last
+    result = dict(conf)
+    for key, value in conf["images"].get(image, {}).items():
+        result[key] = value
+    return result
+
+
+def compress_cmd(conf, level):
+    if conf["codec"] == "zstd":
+        # One thread per core, unless told otherwise
+        threads = conf["threads"] if conf["threads"] is not None else 0
+        cmd = ["zstd", "-q", "-c", f"-{level}", f"-T{threads}"]
+        if level > 19:
+            cmd.append("--ultra")
+        return cmd
+    if conf["codec"] == "lz4":
+        cmd = ["lz4", "-q", "-c", f"-{level}"]
+        if conf["threads"] is not None:
+            # lz4 is multithreaded since 1.10, older ones reject -T
+            cmd.append(f"-T{conf['threads']}")
+        return cmd
+    raise ValueError(f"Unknown compression codec: {conf['codec']}")
+
+
+def timed_cmd(conf, level):
+    # The compress stage, as shell code: once the compressor is done, the
+    # subshell prints the CPU time of its child on stderr (see Stderr)
+    cmd = " ".join(shlex.quote(i) for i in compress_cmd(conf, level))
+    mark = MARK.decode("utf-8")
+    return f"( {cmd}; rc=$?; echo {mark} >&2; times >&2; exit $rc )"
+
+
+class Stderr:
+    # Reads the stderr of an export, until EOF
+    # The CPU time printed by timed_cmd is kept, data is handed to on_data
+    def __init__(self, on_data=None):
+        self.on_data = on_data
+        self.tail = b""
+        self.seconds = None
+
+    def __call__(self, out):
+        while True:
+            data = out.read1(65536)
+            if len(data) == 0:
+                break
+            if self.on_data is not None:
+                self.on_data(data)
+            self.tail = (self.tail + data)[-4096:]
+        out.close()
+        self.seconds = cpu_time(self.tail)
+
+
+def cpu_time(stderr):
+    # The second line of times is for the children: the compressor
+    _, mark, after = stderr.rpartition(MARK)
+    if mark == b"":
+        return None
+    lines = after.split(b"\n")
+    if len(lines) < 3:
+        return None
+    values = TIMES.findall(lines[2])
+    if len(values) != 2:
+        return None
+    return sum(int(m) * 60 + float(s) for m, s in values)
+
+
+def decompress_cmd(conf):
+    if conf["codec"] == "zstd":
+        return ["zstd", "-q", "-d", "-c"]
+    if conf["codec"] == "lz4":
+        return ["lz4", "-q", "-d", "-c"]
+    raise ValueError(f"Unknown compression codec: {conf['codec']}")
+
+
+def pick_level(conf, dest):
+    adaptive = conf["adaptive"]
+    if adaptive is None or adaptive is False:
+        return conf["level"]
+
+    last = state.get_db().execute(
+        "select level, ratio, throughput from compression where dest = ? "
+        "and codec = ? order by date desc limit 1",
+        (dest, conf["codec"]),
+    )
+    last = last.fetchone()
+    if last is None:
+        return conf["level"]
+
+    level, ratio, throughput = last
+    if ratio < adaptive["min_ratio"]:
+        # Barely compressible, do not waste CPU
+        return adaptive["min_level"]
+    if throughput < adaptive["min_throughput"]:
+        # The compressor is too slow at this level
+        # Its own CPU time is measured: the network and shaping do not count
+        return max(adaptive["min_level"], level - 2)
+    # Room left: trade some throughput for a better ratio
+    return min(adaptive["max_level"], level + 1)
+
+
+def record(conf, dest, level, raw, compressed, cpu):
+    # cpu is the CPU time of the compressor, in seconds
+    if compressed == 0 or cpu is None or cpu == 0:
+        return
+    ratio = raw / compressed
+    throughput = raw / cpu
+    Log.debug(
+        f"{dest}: {conf['codec']} level {level}, ratio {ratio:.2f}, "
+        f"{int(throughput)} B per CPU second"
+    )
+    db = state.get_db()
+    db.execute(
+        "insert into compression values (?, ?, ?, ?, ?, strftime('%s', 'now'))",
+        (dest, conf["codec"], level, ratio, throughput),
+    )
+    # Only recent runs are meaningful
+    db.execute(
+        "delete from compression where dest = ? "
+        "and date < strftime('%s', 'now') - 30 * 86400",
+        (dest,),
+    )
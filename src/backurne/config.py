@@ -17,28 +17,76 @@ def dict_merge(dct, merge_dct):
     return dct
 
 
-def load_config():
+def load_config(path="/etc/backurne/backurne.conf"):
     # Default config
     config = {
         "snap_prefix": "backup",
         "profiles": {},
         "profiles_api": None,
+        "coalesce_profiles": False,
         "backup_cluster": {
             "pool": "rbd",
+            "backend": "cli",
         },
         "live_clusters": [],
         "extra_retention_time": 0,
         "ceph_endpoint": {},
         "download_compression": False,
+        "compression": {
+            "codec": None,
+            "level": 3,
+            "threads": None,
+            "adaptive": None,
+            "images": {},
+        },
+        "bandwidth": {
+            "global": None,
+            "clusters": {},
+            "endpoints": {},
+            "schedule": [],
+            "burst": 1,
+        },
+        "concurrency": {
+            "backup": None,
+            "cluster": None,
+            "clusters": {},
+            "endpoint": None,
+            "endpoints": {},
+        },
+        "schedule_policy": "fifo",
+        "metadata_cache": {
+            "size": 4096,
+            "ttl": 300,
+        },
+        "progress": {
+            "dir": "/run/backurne/progress",
+            "interval": 1,
+        },
+        "extent_transfer": {
+            "threshold": None,
+            "streams": 4,
+            "chunk": 64 * 1024**3,
+        },
+        "ssh": {
+            "multiplex": False,
+            "connections": 4,
+            "persist": 600,
+            "alive_interval": 30,
+            "check_interval": 60,
+            "control_dir": "/run/backurne/ssh",
+        },
         "fsfreeze": True,
         "uuid_fallback": True,
         "pretty_colors": True,
         "log_level": "debug",
         "backup_worker": 24,
         "live_worker": 12,
-        "hash_binary": "/usr/bin/xxhsum",
+        "check_worker": 8,
+        "check_endpoint_worker": 2,
         "check_db": "/tmp/backurne.db",
+        "state_db": "/var/lib/backurne/state.db",
         "lockdir": "/var/lock/backurne",
+        "device_timeout": 30,
         "hooks": {
             "pre_vm": None,
             "pre_disk": None,
@@ -58,7 +106,7 @@ def load_config():
 
     custom = types.ModuleType("custom")
     try:
-        exec(open("/etc/backurne/backurne.conf").read(), custom.__dict__)
+        exec(open(path).read(), custom.__dict__)
     except FileNotFoundError:
         return config
 
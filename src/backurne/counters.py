@@ -0,0 +1,178 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+
+from . import cache
+from .config import config
+from .progress import alive
+
+
+PHASES = ("snapshot", "transfer", "expire")
+FIELDS = ("total", "done", "bytes_total", "bytes_done")
+# Hits and misses of the metadata caches, per kind of lookup, for the run
+CACHE = ("hits", "misses")
+
+# The header holds the cluster names, so other processes may read the file
+HEADER = 4096
+VALUE = struct.Struct("<q")
+
+
+class Counters:
+    # Items and bytes, per cluster and per phase, in a file mapped by every
+    # worker: an update is a locked addition, no message is sent anywhere
+    # The backup cluster is named None
+    def __init__(self, clusters):
+        self.clusters = list(clusters)
+        self.path = f"{config['progress']['dir']}/run-{os.getpid()}.counters"
+
+        header = json.dumps({"pid": os.getpid(), "clusters": self.clusters})
+        header = header.encode("utf-8")
+        if len(header) > HEADER:
+            raise ValueError("Too many clusters to count")
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(header.ljust(HEADER, b"\0"))
+            f.write(bytes(size(self.clusters) - HEADER))
+        os.replace(tmp, self.path)
+        self.__open()
+
+    def __open(self):
+        self.lock = threading.Lock()
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), size(self.clusters))
+
+    def __getstate__(self):
+        # Other processes map the same file
+        return {"clusters": self.clusters, "path": self.path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__open()
+
+    def __add(self, values):
+        # Threads share our descriptor, processes are bound by flock
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                for offset, value in values:
+                    value += VALUE.unpack_from(self.map, offset)[0]
+                    VALUE.pack_into(self.map, offset, value)
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def add(self, cluster, phase, **values):
+        index = self.clusters.index(cluster)
+        todo = [(position(index, phase, k), v) for k, v in values.items()]
+        # The metadata cache lookups of this process go along
+        count = len(self.clusters)
+        for kind, delta in cache.take().items():
+            todo += [(cache_position(count, kind, k), v) for k, v in delta.items()]
+        self.__add(todo)
+
+    def values(self):
+        return parse(self.clusters, self.map)
+
+    def sum(self, phases, clusters=None):
+        result = dict.fromkeys(FIELDS, 0)
+        for cluster, by_phase in self.values().items():
+            if clusters is not None and cluster not in clusters:
+                continue
+            for phase in phases:
+                for field in FIELDS:
+                    result[field] += by_phase[phase][field]
+        return result
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def size(clusters):
+    count = len(clusters) * len(PHASES) * len(FIELDS) + len(cache.KINDS) * len(CACHE)
+    return HEADER + count * VALUE.size
+
+
+def position(index, phase, field):
+    offset = (index * len(PHASES) + PHASES.index(phase)) * len(FIELDS)
+    return HEADER + (offset + FIELDS.index(field)) * VALUE.size
+
+
+def cache_position(count, kind, field):
+    # After the values of every cluster
+    offset = count * len(PHASES) * len(FIELDS)
+    offset += cache.KINDS.index(kind) * len(CACHE) + CACHE.index(field)
+    return HEADER + offset * VALUE.size
+
+
+def parse(clusters, data):
+    result = {}
+    for index, cluster in enumerate(clusters):
+        result[cluster] = {}
+        for phase in PHASES:
+            result[cluster][phase] = {
+                field: VALUE.unpack_from(data, position(index, phase, field))[0]
+                for field in FIELDS
+            }
+    return result
+
+
+def parse_cache(clusters, data):
+    return {
+        kind: {
+            field: VALUE.unpack_from(data, cache_position(len(clusters), kind, field))[
+                0
+            ]
+            for field in CACHE
+        }
+        for kind in cache.KINDS
+    }
+
+
+def read():
+    # The counters of every backup run in progress
+    result = []
+    try:
+        names = os.listdir(config["progress"]["dir"])
+    except FileNotFoundError:
+        return result
+
+    for name in sorted(names):
+        if not name.endswith(".counters"):
+            continue
+        path = f"{config['progress']['dir']}/{name}"
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            header = json.loads(data[:HEADER].rstrip(b"\0"))
+        except (OSError, ValueError):
+            continue
+        if not alive(header["pid"]):
+            # Leftover of a killed run
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            continue
+        if len(data) < size(header["clusters"]):
+            continue
+        values = parse(header["clusters"], data)
+        result.append(
+            {
+                "pid": header["pid"],
+                "clusters": [
+                    {"cluster": cluster, "phases": values[cluster]}
+                    for cluster in header["clusters"]
+                ],
+                "cache": parse_cache(header["clusters"], data),
+            }
+        )
+    return result
@@ -1,6 +1,8 @@
 import glob
 import json
 import os
+import select
+import time
 from collections import namedtuple
 
 import humanize
@@ -12,6 +14,7 @@ from sh import lsblk
 from sh import rbd
 
 from .ceph import Ceph
+from .config import config
 from .log import has_debug
 from .log import log as Log
 
@@ -234,10 +237,71 @@ def get_partitions(dev, node, extended=True, mapped=None, qemu_nbd=None):
                 get_partitions(part["name"], sub_node, extended, mapped)
 
 
+class DeviceTimeout(Exception):
+    pass
+
+
+def wait_for(check, what, timeout=None):
+    # sysfs attributes cannot be watched: poll them, quickly at first
+    if timeout is None:
+        timeout = config["device_timeout"]
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    while not check():
+        if time.monotonic() >= deadline:
+            raise DeviceTimeout(f"Timed out after {timeout}s waiting for {what}")
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+
+def read_line(stream, what, timeout=None):
+    # Like readline(), bounded by the same timeout
+    if timeout is None:
+        timeout = config["device_timeout"]
+    deadline = time.monotonic() + timeout
+    fd = stream.fileno()
+    data = b""
+    while b"\n" not in data:
+        left = deadline - time.monotonic()
+        if left <= 0 or len(select.select([fd], [], [], left)[0]) == 0:
+            raise DeviceTimeout(f"Timed out after {timeout}s waiting for {what}")
+        chunk = os.read(fd, 4096)
+        if chunk == b"":
+            break
+        data += chunk
+    return data.split(b"\n", 1)[0].decode("utf-8").strip()
+
+
+def nbd_connected(dev):
+    # The pid file exists as long as a client holds the device
+    name = os.path.basename(dev)
+    if not os.path.exists(f"/sys/block/{name}/pid"):
+        return False
+    try:
+        with open(f"/sys/block/{name}/size") as f:
+            size = int(f.read())
+    except (OSError, ValueError):
+        return False
+    return size > 0 and os.path.exists(dev)
+
+
+def wait_nbd(dev, connected=True, timeout=None):
+    if connected:
+        wait_for(lambda: nbd_connected(dev), f"{dev} to be connected", timeout)
+    else:
+        name = os.path.basename(dev)
+        wait_for(
+            lambda: not os.path.exists(f"/sys/block/{name}/pid"),
+            f"{dev} to be disconnected",
+            timeout,
+        )
+
+
 def wait_dev(dev):
+    # Only wait for the events of this device, not for the whole udev queue
     Log.debug(f"udevadm trigger {dev} -w")
     sh.Command("udevadm")("trigger", dev, "-w")
-    sh.Command("udevadm")("settle")
+    wait_for(lambda: os.path.exists(dev), dev)
 
 
 def print_node(pre, _node):
@@ -0,0 +1,55 @@
+from . import state
+from .config import config
+from .log import log as Log
+
+
+def estimate(ceph, image, snap, last_snap=None):
+    # How many bytes a backup will transfer, or None if we cannot tell
+    if config["schedule_policy"] == "fifo":
+        return None
+    try:
+        if last_snap is None:
+            # Full backup
+            return ceph.info(f"{image}@{snap}")["size"]
+        return sum(i["length"] for i in ceph.diff(image, snap, last_snap))
+    except Exception as e:
+        Log.debug(f"Cannot estimate {image}@{snap}: {e}")
+        return None
+
+
+def size_key(size):
+    # Sort key used by the scheduler, among jobs of the same priority
+    policy = config["schedule_policy"]
+    if size is None or policy == "fifo":
+        return 0
+    if policy == "longest-first":
+        return -size
+    if policy == "shortest-first":
+        return size
+    raise ValueError(f"Unknown schedule_policy: {policy}")
+
+
+def record(dest, snap, estimated):
+    if estimated is None:
+        return
+    db = state.get_db()
+    db.execute(
+        "insert or replace into estimates "
+        "values (?, ?, ?, null, strftime('%s', 'now'))",
+        (dest, snap, estimated),
+    )
+    db.execute("delete from estimates where date < strftime('%s', 'now') - 30 * 86400")
+
+
+def record_actual(dest, snap, actual):
+    db = state.get_db()
+    row = db.execute(
+        "select estimated from estimates where dest = ? and snap = ?", (dest, snap)
+    ).fetchone()
+    if row is None:
+        return
+    Log.debug(f"{dest}@{snap}: estimated {row[0]} bytes, transferred {actual}")
+    db.execute(
+        "update estimates set actual = ? where dest = ? and snap = ?",
+        (actual, dest, snap),
+    )
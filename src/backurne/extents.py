@@ -0,0 +1,108 @@
+import base64
+import struct
+
+
+# This script runs on the live cluster, using python3-rbd.
+# It writes an export-diff stream (rbd diff v1) restricted to a range of
+# the image: only data records, no end snapshot. Thus, rbd import-diff
+# applies the data but does not create the snapshot: that is our job, once
+# every range has been applied.
+EXPORT_SCRIPT = r"""
+import struct
+import sys
+
+import rados
+import rbd
+
+pool, namespace, image, snap, from_snap, start, end = sys.argv[1:8]
+start = int(start)
+end = int(end)
+out = sys.stdout.buffer
+
+cluster = rados.Rados(conffile="/etc/ceph/ceph.conf")
+cluster.connect()
+ioctx = cluster.open_ioctx(pool)
+if namespace != "":
+    ioctx.set_namespace(namespace)
+img = rbd.Image(ioctx, image, snapshot=snap, read_only=True)
+
+out.write(b"rbd diff v1\n")
+if from_snap != "":
+    name = from_snap.encode("utf-8")
+    out.write(b"f" + struct.pack("<I", len(name)) + name)
+
+extents = []
+img.diff_iterate(
+    start,
+    end - start,
+    from_snap or None,
+    lambda offset, length, exists: extents.append((offset, length, exists)),
+    whole_object=True,
+)
+
+chunk = 4 << 20
+for offset, length, exists in extents:
+    if not exists:
+        out.write(b"z" + struct.pack("<QQ", offset, length))
+        continue
+    while length > 0:
+        size = min(length, chunk)
+        data = img.read(offset, size)
+        if data == bytes(size):
+            if from_snap != "":
+                out.write(b"z" + struct.pack("<QQ", offset, size))
+            # else: full transfer into a new image, zeroes are free
+        else:
+            out.write(b"w" + struct.pack("<QQ", offset, size))
+            out.write(data)
+        offset += size
+        length -= size
+out.write(b"e")
+out.flush()
+"""
+
+
+def python_cmd(script):
+    # The script is passed as a single shell-safe word
+    script = base64.b64encode(script.encode("utf-8")).decode("ascii")
+    return ["python3", "-c", f"exec(__import__('base64').b64decode('{script}'))"]
+
+
+def export_cmd(pool, namespace, image, snap, from_snap, start, end):
+    args = [pool, namespace or "", image, snap, from_snap or "", start, end]
+    return python_cmd(EXPORT_SCRIPT) + [str(i) for i in args]
+
+
+def header(size, from_snap=None):
+    # A data-less stream: import-diff checks that from_snap exists on the
+    # destination, and resizes it
+    result = b"rbd diff v1\n"
+    if from_snap is not None:
+        name = from_snap.encode("utf-8")
+        result += b"f" + struct.pack("<I", len(name)) + name
+    result += b"s" + struct.pack("<Q", size)
+    result += b"e"
+    return result
+
+
+def split(extents, count, size):
+    # Cut the image in at most count ranges, holding the same amount of
+    # changed data. Cuts are made on extent boundaries
+    total = sum(i["length"] for i in extents)
+    if total == 0 or count <= 1:
+        return [(0, size)]
+
+    target = total / count
+    ranges = []
+    start = 0
+    done = 0
+    for extent in sorted(extents, key=lambda x: x["offset"]):
+        done += extent["length"]
+        if done < target * (len(ranges) + 1) or len(ranges) == count - 1:
+            continue
+        end = extent["offset"] + extent["length"]
+        ranges.append((start, end))
+        start = end
+    if start < size:
+        ranges.append((start, size))
+    return ranges
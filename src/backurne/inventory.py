@@ -0,0 +1,99 @@
+from .log import log as Log
+
+
+# Inventories are stored per process, indexed by the rbd command used to
+# reach the pool. That way, they are inherited by forked workers, and are
+# never pickled along with the Ceph objects that flow through the queues.
+inventories = {}
+
+
+class Inventory:
+    def __init__(self, entries):
+        self.images = {}
+
+        snaps = []
+        for entry in entries:
+            if "snapshot" in entry:
+                snaps.append(entry)
+                continue
+            self.images[entry["image"]] = {
+                "size": entry.get("size", 0),
+                "snaps": {},
+            }
+
+        # rbd lists snapshots ordered by id, but let's not rely on that
+        snaps.sort(key=lambda x: x.get("snapshot_id", 0))
+        for snap in snaps:
+            if snap["image"] not in self.images:
+                continue
+            self.add_snap(
+                snap["image"],
+                snap["snapshot"],
+                protected=snap.get("protected") in (True, "true"),
+                size=snap.get("size", 0),
+            )
+
+    def __len__(self):
+        return len(self.images)
+
+    def ls(self):
+        return list(self.images.keys())
+
+    def exists(self, image):
+        return image in self.images
+
+    def size(self, image):
+        return self.images[image]["size"]
+
+    def snap(self, image):
+        return list(self.images[image]["snaps"].keys())
+
+    def protected(self, image, snap):
+        return self.images[image]["snaps"][snap]["protected"]
+
+    def add(self, image, size=0):
+        if image in self.images:
+            return
+        self.images[image] = {"size": size, "snaps": {}}
+
+    def rm(self, image):
+        self.images.pop(image, None)
+
+    def rename(self, image, dest):
+        self.images[dest] = self.images.pop(image)
+
+    def add_snap(self, image, snap, protected=False, size=None):
+        self.add(image)
+        if size is None:
+            size = self.images[image]["size"]
+        self.images[image]["snaps"][snap] = {
+            "protected": protected,
+            "size": size,
+        }
+
+    def rm_snap(self, image, snap):
+        try:
+            del self.images[image]["snaps"][snap]
+        except KeyError:
+            pass
+
+    def set_protected(self, image, snap, protected):
+        try:
+            self.images[image]["snaps"][snap]["protected"] = protected
+        except KeyError:
+            pass
+
+
+def get(key):
+    return inventories.get(key)
+
+
+def register(key, entries):
+    inventory = Inventory(entries)
+    inventories[key] = inventory
+    Log.debug(f"Inventory loaded for {key}: {len(inventory)} images")
+    return inventory
+
+
+def drop(key):
+    inventories.pop(key, None)
@@ -0,0 +1,116 @@
+import os
+import socket
+
+from . import snapshot
+from . import state
+from .progress import alive
+
+
+# The run of this process, set by start()
+# Like inventories, it is inherited by forked workers
+run = None
+
+# What happens to a snapshot, from its creation
+SNAPSHOTTED = "snapshotted"
+TRANSFERRING = "transferring"
+TRANSFERRED = "transferred"
+EXPIRED = "expired"
+
+
+def start():
+    global run
+    db = state.get_db()
+    cursor = db.execute(
+        "insert into runs (start, pid, host) values (strftime('%s', 'now'), ?, ?)",
+        (os.getpid(), socket.gethostname()),
+    )
+    run = cursor.lastrowid
+    db.execute("delete from runs where start < strftime('%s', 'now') - 30 * 86400")
+    db.execute("delete from journal where updated < strftime('%s', 'now') - 30 * 86400")
+    return run
+
+
+def finish():
+    state.get_db().execute(
+        "update runs set end = strftime('%s', 'now') where run = ?", (run,)
+    )
+
+
+def unfinished():
+    # The other runs that never finished: (run, start, still running)
+    # The runs of another host cannot be checked, they may be running
+    rows = state.get_db().execute(
+        "select run, start, pid, host from runs where end is null and run != ? "
+        "order by run",
+        (run,),
+    )
+    host = socket.gethostname()
+    return [(i[0], i[1], i[3] != host or alive(i[2])) for i in rows.fetchall()]
+
+
+def interrupted():
+    # The start of the last run that died before finishing, if any
+    dead = [start for _, start, running in unfinished() if not running]
+    return dead[-1] if len(dead) != 0 else None
+
+
+def snapshotted(cluster, dest, snap, last_snap, priority):
+    state.get_db().execute(
+        "insert or replace into journal "
+        "values (?, ?, ?, ?, ?, ?, ?, strftime('%s', 'now'))",
+        (run, cluster, dest, snap, last_snap, priority, SNAPSHOTTED),
+    )
+
+
+def update(dest, snap, new):
+    state.get_db().execute(
+        "update journal set state = ?, updated = strftime('%s', 'now') "
+        "where dest = ? and snap = ?",
+        (new, dest, snap),
+    )
+
+
+def expired(snaps):
+    # Snapshots that expiry removed from the backup cluster, as (dest, snap)
+    state.get_db().executemany(
+        "update journal set state = ?, updated = strftime('%s', 'now') "
+        "where dest = ? and snap = ?",
+        [(EXPIRED, dest, snap) for dest, snap in snaps],
+    )
+
+
+def transferred(cluster):
+    # What this run transferred from a cluster, oldest first
+    rows = (
+        state.get_db()
+        .execute(
+            "select dest, snap from journal where run = ? and cluster = ? "
+            "and state = ?",
+            (run, cluster, TRANSFERRED),
+        )
+        .fetchall()
+    )
+    return sorted(rows, key=lambda x: snapshot.sort_key(x[1]))
+
+
+def drop(dest, snap):
+    state.get_db().execute(
+        "delete from journal where dest = ? and snap = ?", (dest, snap)
+    )
+
+
+def pending(dest):
+    # Snapshots created by previous runs, yet never transferred, oldest first
+    # Those of a run still in progress are its own business
+    running = {i[0] for i in unfinished() if i[2]}
+    rows = (
+        state.get_db()
+        .execute(
+            "select run, snap, last_snap, priority from journal "
+            "where dest = ? and state in (?, ?) and run != ?",
+            (dest, SNAPSHOTTED, TRANSFERRING, run),
+        )
+        .fetchall()
+    )
+    rows = [i[1:] for i in rows if i[0] not in running]
+    return sorted(rows, key=lambda x: snapshot.sort_key(x[0]))
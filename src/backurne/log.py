@@ -32,7 +32,7 @@ class ConsoleFormatter(logging.Formatter):
         return logging.Formatter.format(self, record)
 
 
-def report_to_influx(image, endpoint, duration):
+def report_to_influx(image, endpoint, duration, size=None):
     from influxdb import InfluxDBClient
 
     conf = config["influxdb"]
@@ -72,20 +72,24 @@ def report_to_influx(image, endpoint, duration):
             },
         }
     ]
+    if size is not None:
+        data[0]["fields"]["bytes"] = size
 
     influx.write_points(data)
 
 
-def report_time(image, endpoint, duration):
+def report_time(image, endpoint, duration, size=None):
     if config["report_time"] is None:
         return
 
     msg = f"Image {image} from {endpoint} backed up, eelapsed time: {duration}"
+    if size is not None:
+        msg = f"{msg}, {size} bytes transferred"
     msg = f"{datetime.datetime.now()}: {msg}"
     if config["report_time"] == "syslog":
         syslog.syslog(syslog.LOG_INFO, msg)
     elif config["report_time"] == "influxdb":
-        report_to_influx(image, endpoint, duration)
+        report_to_influx(image, endpoint, duration, size)
     else:
         with open(config["report_time"], "a") as f:
             f.write(f"{msg}\n")
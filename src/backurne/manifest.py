@@ -0,0 +1,191 @@
+import hashlib
+import json
+import struct
+
+from . import state
+from .log import log as Log
+
+
+# This script runs on the cluster holding the image, using python3-rbd.
+# It hashes the fixed-size chunks of a snapshot that changed since
+# from_snap, or every allocated chunk if there is no from_snap. Chunks do
+# not depend on the object size, which import-diff does not carry to the
+# backup image: both sides are hashed the same way. The last
+# chunk, before and after a resize, is always hashed: its length may have
+# changed. Chunks that are not reported are unchanged (or zero).
+# Output: a json header line, then (index, digest) records.
+HASH_SCRIPT = r"""
+import hashlib
+import json
+import struct
+import sys
+
+import rados
+import rbd
+
+pool, namespace, image, snap, from_snap, from_size, chunk = sys.argv[1:8]
+from_size = int(from_size)
+chunk = int(chunk)
+out = sys.stdout.buffer
+
+cluster = rados.Rados(conffile="/etc/ceph/ceph.conf")
+cluster.connect()
+ioctx = cluster.open_ioctx(pool)
+if namespace != "":
+    ioctx.set_namespace(namespace)
+img = rbd.Image(ioctx, image, snapshot=snap, read_only=True)
+size = img.size()
+out.write(json.dumps({"size": size, "chunk": chunk}).encode("utf-8") + b"\n")
+
+changed = set()
+
+
+def mark(offset, length, exists):
+    for i in range(offset // chunk, (offset + length - 1) // chunk + 1):
+        changed.add(i)
+
+
+img.diff_iterate(0, size, from_snap or None, mark, whole_object=True)
+for boundary in (from_size, size):
+    if boundary > 0:
+        changed.add((boundary - 1) // chunk)
+
+for i in sorted(changed):
+    if i * chunk >= size:
+        continue
+    data = img.read(i * chunk, min(chunk, size - i * chunk))
+    out.write(struct.pack("<Q", i) + hashlib.blake2b(data, digest_size=16).digest())
+out.flush()
+"""
+
+DIGEST = 16
+CHUNK = 4 * 1024**2
+RECORD = struct.Struct(f"<Q{DIGEST}s")
+
+
+def zero_digest(length):
+    return hashlib.blake2b(bytes(length), digest_size=DIGEST).digest()
+
+
+def parse(output):
+    header, _, body = output.partition(b"\n")
+    header = json.loads(header.decode("utf-8"))
+    records = [RECORD.unpack_from(body, i) for i in range(0, len(body), RECORD.size)]
+    return header["size"], header["chunk"], records
+
+
+class Manifest:
+    # The digest of every chunk of a snapshot, chunk by chunk
+    def __init__(self, size, chunk, digests):
+        self.size = size
+        self.chunk = chunk
+        self.digests = digests
+
+    @property
+    def count(self):
+        return (self.size + self.chunk - 1) // self.chunk
+
+    def digest(self, index):
+        return self.digests[index * DIGEST : (index + 1) * DIGEST]
+
+    def derive(self, size, chunk, records):
+        # Build the manifest of a later snapshot, from the changed chunks
+        # Both use the same chunk size, see CHUNK
+        result = Manifest(
+            size, chunk, bytearray(self.digests[: size // chunk * DIGEST])
+        )
+        if len(result.digests) < result.count * DIGEST:
+            # Grown, and not yet written: zeroes
+            missing = result.count - len(result.digests) // DIGEST
+            result.digests += zero_digest(chunk) * missing
+        for index, digest in records:
+            result.digests[index * DIGEST : (index + 1) * DIGEST] = digest
+        result.digests = bytes(result.digests)
+        return result
+
+    def diff(self, other):
+        # The offsets of the chunks that do not match
+        if self.size != other.size or self.chunk != other.chunk:
+            return None
+        if self.digests == other.digests:
+            return []
+        return [
+            i * self.chunk
+            for i in range(self.count)
+            if self.digest(i) != other.digest(i)
+        ]
+
+
+class Manifests:
+    # The manifests of an image's snapshots, stored in the state db
+    # A snapshot's manifest is derived from the latest older snapshot that
+    # has one, so that only the changed chunks are read.
+    # snaps must be sorted, oldest first
+    def __init__(self, ceph, image, snaps, full=False):
+        self.ceph = ceph
+        self.image = image
+        self.snaps = snaps
+        self.db = state.get_db()
+        if full:
+            self.__prune([])
+        else:
+            self.__prune(snaps)
+
+    def __prune(self, snaps):
+        rows = self.db.execute(
+            "select snap from manifests where key = ? and image = ?",
+            (self.ceph.key, self.image),
+        )
+        for (snap,) in rows.fetchall():
+            if snap in snaps:
+                continue
+            self.db.execute(
+                "delete from manifests where key = ? and image = ? and snap = ?",
+                (self.ceph.key, self.image, snap),
+            )
+
+    def __load(self, snap):
+        row = self.db.execute(
+            "select size, chunk, digests from manifests "
+            "where key = ? and image = ? and snap = ?",
+            (self.ceph.key, self.image, snap),
+        ).fetchone()
+        if row is None or row[1] != CHUNK:
+            # Older manifests were hashed per RBD object
+            return None
+        return Manifest(row[0], row[1], row[2])
+
+    def __store(self, snap, manifest):
+        self.db.execute(
+            "insert or replace into manifests values (?, ?, ?, ?, ?, ?)",
+            (
+                self.ceph.key,
+                self.image,
+                snap,
+                manifest.size,
+                manifest.chunk,
+                manifest.digests,
+            ),
+        )
+
+    def get(self, snap):
+        result = self.__load(snap)
+        if result is not None:
+            return result
+
+        base_snap = None
+        base = Manifest(0, 0, b"")
+        for prev in reversed(self.snaps[: self.snaps.index(snap)]):
+            prev_manifest = self.__load(prev)
+            if prev_manifest is not None:
+                base_snap = prev
+                base = prev_manifest
+                break
+
+        Log.debug(f"Hashing {self.image}@{snap} (from {base_snap}) on {self.ceph}")
+        size, chunk, records = self.ceph.hash_chunks(
+            self.image, snap, base_snap, base.size
+        )
+        result = base.derive(size, chunk, records)
+        self.__store(snap, result)
+        return result
@@ -0,0 +1,142 @@
+import json
+import os
+import re
+import threading
+import time
+
+import setproctitle
+
+from .config import config
+
+
+# rbd reports its progress on stderr, as "Exporting image: 42% complete..."
+PERCENT = re.compile(rb"(\d+)% complete")
+
+
+class Progress:
+    # Tracks one transfer: bytes seen in the pipe, and the percentage
+    # reported by rbd. A json record is published in progress_dir, at most
+    # once per interval, for the CLI, the API and anything else to read
+    def __init__(self, image, dest, endpoint=None, total=None):
+        self.image = image
+        self.dest = dest
+        self.endpoint = endpoint
+        self.total = total
+        self.bytes = 0
+        self.percent = None
+        self.pending = b""
+        self.start = time.time()
+        self.published = 0
+        self.lock = threading.Lock()
+        self.title = setproctitle.getproctitle()
+
+        name = dest.replace("/", "")
+        self.path = f"{config['progress']['dir']}/{os.getpid()}-{name}.json"
+
+    def on_data(self, size):
+        with self.lock:
+            self.bytes += size
+        self.publish()
+
+    def feed(self, data):
+        # What rbd printed on stderr
+        # Lines are terminated by \r, not by \n
+        *lines, self.pending = re.split(rb"[\r\n]", self.pending + data)
+        for line in reversed(lines):
+            match = PERCENT.search(line)
+            if match is not None:
+                self.percent = int(match.group(1))
+                break
+        self.publish()
+
+    def record(self):
+        now = time.time()
+        elapsed = now - self.start
+        rate = self.bytes / elapsed if elapsed > 0 else 0
+
+        percent = self.percent
+        if percent is None and self.total:
+            percent = min(100, int(self.bytes * 100 / self.total))
+
+        eta = None
+        if percent is not None and 0 < percent < 100:
+            eta = int(elapsed * (100 - percent) / percent)
+
+        return {
+            "image": self.image,
+            "dest": self.dest,
+            "endpoint": self.endpoint,
+            "pid": os.getpid(),
+            "bytes": self.bytes,
+            "total": self.total,
+            "rate": int(rate),
+            "percent": percent,
+            "eta": eta,
+            "start": int(self.start),
+            "updated": int(now),
+        }
+
+    def publish(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.published < config["progress"]["interval"]:
+            return
+        self.published = now
+
+        record = self.record()
+        if record["percent"] is not None:
+            setproctitle.setproctitle(f"{self.title} ({record['percent']}% complete)")
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(record, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            # Progress is informative only
+            pass
+
+    def close(self):
+        setproctitle.setproctitle(self.title)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read():
+    # Every transfer in progress
+    result = []
+    try:
+        names = os.listdir(config["progress"]["dir"])
+    except FileNotFoundError:
+        return result
+
+    for name in sorted(names):
+        if not name.endswith(".json"):
+            continue
+        path = f"{config['progress']['dir']}/{name}"
+        try:
+            with open(path) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not alive(record["pid"]):
+            # Leftover of a killed process
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            continue
+        result.append(record)
+    return result
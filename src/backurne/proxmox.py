@@ -38,7 +38,11 @@ class Proxmox:
             name = storage["storage"]
             endpoint = self.__get_ceph_endpoint(name)
             result[name] = Ceph(
-                storage["pool"], namespace=storage.get("namespace"), endpoint=endpoint
+                storage["pool"],
+                namespace=storage.get("namespace"),
+                endpoint=endpoint,
+                compression=self.px_config.get("compression"),
+                name=self.px_config["name"],
             )
         return result
 
@@ -2,9 +2,9 @@ import glob
 import os.path
 import tempfile
 
-import dateutil.parser
 import sh
 
+from . import snapshot
 from .ceph import Ceph
 from .disk import deactivate_vg
 from .disk import filter_children
@@ -47,8 +47,7 @@ class Restore:
                 )
         else:
             for i in self.ceph.snap(self.rbd):
-                split = i.split(";")
-                creation = dateutil.parser.parse(split[3])
+                creation = snapshot.parse(i).date
                 result.append(
                     {
                         "creation": creation,
@@ -0,0 +1,300 @@
+import time
+
+from . import snapshot
+from . import state
+from .config import config
+from .log import log as Log
+
+
+def plan_image(image, snaps, protected=(), now=None):
+    # What expiry does to one backup image, snaps being all of its
+    # snapshots, oldest first
+    # Every expired snapshot is removed, but the last one: it is kept until
+    # it expires by itself, extra_retention_time included. The image is
+    # removed along with its last snapshot
+    plan = {
+        "image": image,
+        "snaps": [],
+        "protected": [],
+        "last": False,
+        "rm": False,
+        "purge": False,
+    }
+
+    ours = [i for i in snaps if i.startswith(config["snap_prefix"])]
+    if len(ours) == 0:
+        # Someone is messing around, or this is a bug
+        # Anyway, the image can be deleted, if nothing else holds it
+        plan["rm"] = len(snaps) == 0
+        return plan
+
+    *older, last = ours
+    for snap in older:
+        if not snapshot.parse(snap).is_expired(now=now):
+            continue
+        if snap in protected:
+            plan["protected"].append(snap)
+            continue
+        plan["snaps"].append(snap)
+
+    if len(plan["snaps"]) != len(older):
+        return plan
+    if not snapshot.parse(last).is_expired(last=True, now=now):
+        return plan
+    if last in protected:
+        plan["protected"].append(last)
+        return plan
+
+    plan["snaps"].append(last)
+    plan["last"] = True
+    # Nothing is left: the image goes too. All its snapshots may then be
+    # purged at once, instead of one by one
+    plan["rm"] = len(ours) == len(snaps)
+    plan["purge"] = plan["rm"]
+    return plan
+
+
+def plan_live(snaps, backups):
+    # What expiry deletes from a live image, backups being the snapshots
+    # of its backup image
+    # The last shared snapshot is kept, and so is everything after it: a
+    # backup may be pending elsewhere. Before it, the max_on_live latest
+    # snapshots of each profile are kept, those of unknown profiles are not
+    # A coalesced snapshot is kept if any of its profiles keeps it
+    shared = snapshot.last(set(backups).intersection(snaps))
+    if shared is None:
+        return []
+    limit = snapshot.sort_key(shared)
+
+    older = []
+    by_profile = {}
+    for snap in snaps:
+        if snapshot.sort_key(snap) >= limit:
+            continue
+        older.append(snap)
+        for profile in snapshot.parse(snap).profiles:
+            by_profile.setdefault(profile, []).append(snap)
+
+    kept = set()
+    for profile, snaps in by_profile.items():
+        try:
+            keep = config["profiles"][profile].get("max_on_live", 1)
+        except KeyError:
+            # Profile no longer exists, we can drop all these snaps
+            continue
+        kept.update(snaps[max(len(snaps) - keep, 0) :])
+    return [i for i in older if i not in kept]
+
+
+def recheck(plan, snaps):
+    # The plan of an image, against its snapshots of now: the plan may be
+    # older than some transfer. Only the planned snapshots are removed, and
+    # the image goes only if nothing else came in
+    result = dict(plan)
+    result["snaps"] = [i for i in plan["snaps"] if i in snaps]
+    if set(snaps) != set(plan["snaps"]):
+        result["last"] = False
+        result["rm"] = False
+        result["purge"] = False
+    return result
+
+
+def snaps_of(ceph, image):
+    # All the snapshots of an image, from the inventory if there is one
+    inv = ceph.inventory
+    if inv is not None:
+        snaps = inv.snap(image)
+        protected = [i for i in snaps if inv.protected(image, i)]
+        return snaps, protected
+
+    entries = ceph.backend.snap_entries(image)
+    snaps = [i["name"] for i in entries]
+    protected = [i["name"] for i in entries if i["protected"]]
+    return snaps, protected
+
+
+def plan_backup(ceph, now=None, images=None):
+    # The whole deletion set of the backup pool, or of some of its images,
+    # from a single pass over its inventory
+    if images is None:
+        images = ceph.ls()
+
+    # Their pending transfers will be resumed: the partial data must stay
+    pending = state.checkpointed()
+
+    result = []
+    for image in images:
+        if not ceph.exists(image):
+            continue
+        if image in pending:
+            Log.debug(f"{image} has an interrupted transfer, not expired")
+            continue
+        snaps, protected = snaps_of(ceph, image)
+        try:
+            plan = plan_image(image, snaps, protected, now)
+        except ValueError as e:
+            Log.warning(f"Cannot plan the expiry of {image}: {e}")
+            continue
+        if plan["snaps"] or plan["rm"] or plan["protected"]:
+            result.append(plan)
+    return result
+
+
+def usage(ceph):
+    # Bytes used by every image and snapshot of a pool, from a single du
+    result = {}
+    for i in ceph.du()["images"]:
+        result[(i["name"], i.get("snapshot"))] = i["used_size"]
+    return result
+
+
+class Simulation:
+    # What expiry would delete, over the whole estate, without touching it
+    # Freed space is estimated from the bytes used by each snapshot (and by
+    # the image itself, when removed), as reported by rbd du
+    def __init__(self, sizes=True):
+        self.sizes = sizes
+        self.usages = {}
+        self.clusters = {}
+        self.images = []
+
+    def __used(self, ceph, image, snaps, rm):
+        if not self.sizes:
+            return None
+        if ceph.key not in self.usages:
+            try:
+                self.usages[ceph.key] = usage(ceph)
+            except Exception as e:
+                Log.warning(f"Cannot compute the usage of {ceph.pool}: {e}")
+                self.usages[ceph.key] = None
+        used = self.usages[ceph.key]
+        if used is None:
+            return None
+        if rm:
+            snaps = snaps + [None]
+        return sum(used.get((image, i), 0) for i in snaps)
+
+    def __cluster(self, name):
+        if name not in self.clusters:
+            self.clusters[name] = {
+                "cluster": name,
+                "total": 0,
+                "snaps": 0,
+                "protected": 0,
+                "images": 0,
+                "freed": 0 if self.sizes else None,
+            }
+        return self.clusters[name]
+
+    def __add(self, name, ceph, image, snaps, total, protected=(), rm=False):
+        cluster = self.__cluster(name)
+        cluster["total"] += total
+        if not snaps and not rm and not protected:
+            return
+
+        freed = self.__used(ceph, image, snaps, rm)
+        cluster["snaps"] += len(snaps)
+        cluster["protected"] += len(protected)
+        cluster["images"] += 1 if rm else 0
+        if freed is None:
+            cluster["freed"] = None
+        elif cluster["freed"] is not None:
+            cluster["freed"] += freed
+        self.images.append(
+            {
+                "cluster": name,
+                "image": image,
+                "snaps": snaps,
+                "protected": list(protected),
+                "rm": rm,
+                "freed": freed,
+            }
+        )
+
+    def live(self, name, ceph, image, dest):
+        snaps = ceph.snap(image)
+        if not ceph.backup.exists(dest):
+            # Never backed up: expiry leaves it alone
+            self.__add(name, ceph, image, [], len(snaps))
+            return
+        backups = ceph.backup.snap(dest)
+        self.__add(name, ceph, image, plan_live(snaps, backups), len(snaps))
+
+    def backup(self, ceph, now=None):
+        # The backup cluster is named None
+        plans = {i["image"]: i for i in plan_backup(ceph, now)}
+        for image in ceph.ls():
+            total = len(ceph.snap(image))
+            plan = plans.get(image)
+            if plan is None:
+                self.__add(None, ceph, image, [], total)
+                continue
+            self.__add(
+                None,
+                ceph,
+                image,
+                plan["snaps"],
+                total,
+                plan["protected"],
+                plan["rm"],
+            )
+
+    def result(self):
+        return {
+            "clusters": list(self.clusters.values()),
+            "images": self.images,
+        }
+
+
+class Report:
+    # What an expiry job did, and what it had to skip
+    def __init__(self):
+        self.start = time.monotonic()
+        self.snaps = 0
+        self.images = 0
+        self.locked = []
+        self.protected = []
+        self.failed = []
+        self.removed = []
+
+    def add(self, result):
+        self.snaps += result["snaps"]
+        self.images += result["images"]
+        self.locked += result["locked"]
+        self.protected += result["protected"]
+        self.failed += result["failed"]
+        self.removed += result["removed"]
+
+    def duration(self):
+        return time.monotonic() - self.start
+
+    def log(self, where):
+        Log.info(
+            f"Expired {self.snaps} snapshots and {self.images} images from "
+            f"{where} in {self.duration():.1f}s"
+        )
+        if self.locked or self.protected or self.failed:
+            Log.info(
+                f"Skipped: {len(self.locked)} locked images, "
+                f"{len(self.protected)} protected snapshots, "
+                f"{len(self.failed)} failed deletions"
+            )
+        for i in self.locked:
+            Log.debug(f"Skipped {i}: locked")
+        for i in self.protected:
+            Log.debug(f"Skipped {i}: protected")
+        for i in self.failed:
+            Log.debug(f"Skipped {i}: cannot be deleted")
+
+
+def result():
+    # What a worker did to one image, see Report.add
+    # removed holds the (image, snap) that were deleted
+    return {
+        "snaps": 0,
+        "images": 0,
+        "locked": [],
+        "protected": [],
+        "failed": [],
+        "removed": [],
+    }
@@ -0,0 +1,63 @@
+import heapq
+import itertools
+import threading
+from multiprocessing.managers import SyncManager
+
+
+PRIORITIES = {
+    "low": -10,
+    "normal": 0,
+    "high": 10,
+}
+
+
+def priority(value):
+    # Profiles may use a named level, or any integer
+    if value is None:
+        return PRIORITIES["normal"]
+    if isinstance(value, int):
+        return value
+    return PRIORITIES.get(value, PRIORITIES["normal"])
+
+
+class Scheduler:
+    # A priority queue, living in a manager process
+    # Consumers block in get() until some work is queued: the highest
+    # priority first, then the lowest key (see estimate.size_key), then
+    # the oldest. Once closed and drained, get() returns None to everyone
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count()
+        self.closed = False
+
+    def put(self, item, priority=0, key=0):
+        with self.cond:
+            if self.closed:
+                raise ValueError("Cannot queue work into a closed scheduler")
+            heapq.heappush(self.heap, (-priority, key, next(self.counter), item))
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while len(self.heap) == 0 and not self.closed:
+                self.cond.wait()
+            if len(self.heap) == 0:
+                return None
+            return heapq.heappop(self.heap)[-1]
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.heap)
+
+
+class Manager(SyncManager):
+    pass
+
+
+Manager.register("Scheduler", Scheduler)
@@ -0,0 +1,141 @@
+import datetime
+import fcntl
+import os
+import struct
+import time
+
+from .config import config
+
+
+# A bucket is a small file: the current amount of tokens, and when it was
+# last refilled. Every process (consumer) shares it, through flock.
+# Tokens are reserved before being available: the bucket goes negative and
+# the reserver sleeps the debt off. Thus an idle process takes nothing, and
+# the rate is split among the active ones.
+BUCKET = struct.Struct("<dd")
+
+# Transfers are fed by small chunks: their bytes are reserved by batches,
+# or at least every slice (in seconds) when the stream is slow
+BATCH = 4 * 1024**2
+SLICE = 0.1
+
+
+def in_window(window, now):
+    days = window.get("days")
+    if days is not None and now.weekday() not in days:
+        return False
+    start = datetime.time.fromisoformat(window["start"])
+    end = datetime.time.fromisoformat(window["end"])
+    if start <= end:
+        return start <= now.time() < end
+    # Spans midnight
+    return now.time() >= start or now.time() < end
+
+
+def rates(now=None):
+    # The caps that apply now: the defaults, overridden by every
+    # active schedule window
+    if now is None:
+        now = datetime.datetime.now()
+    conf = config["bandwidth"]
+    result = {
+        "global": conf["global"],
+        "clusters": dict(conf["clusters"]),
+        "endpoints": dict(conf["endpoints"]),
+    }
+    for window in conf["schedule"]:
+        if not in_window(window, now):
+            continue
+        if "global" in window:
+            result["global"] = window["global"]
+        result["clusters"].update(window.get("clusters", {}))
+        result["endpoints"].update(window.get("endpoints", {}))
+    return result
+
+
+class Bucket:
+    def __init__(self, name):
+        name = name.replace("/", "")
+        self.path = f"{config['lockdir']}/bandwidth-{name}"
+
+    def reserve(self, size, rate):
+        # Returns how long we must wait before sending size bytes
+        burst = rate * config["bandwidth"]["burst"]
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.monotonic()
+            data = os.pread(fd, BUCKET.size, 0)
+            if len(data) == BUCKET.size:
+                tokens, last = BUCKET.unpack(data)
+                if last > now:
+                    # Written before a reboot: monotonic clocks restart
+                    tokens, last = burst, now
+            else:
+                tokens, last = burst, now
+            tokens = min(burst, tokens + (now - last) * rate)
+            tokens -= size
+            os.pwrite(fd, BUCKET.pack(tokens, now), 0)
+        finally:
+            os.close(fd)
+        if tokens >= 0:
+            return 0
+        return -tokens / rate
+
+
+class Shaper:
+    # Throttles a transfer against every cap that applies to it
+    # Caps are bytes per second, None means unlimited
+    def __init__(self, cluster=None, endpoint=None):
+        self.cluster = cluster
+        self.endpoint = endpoint
+        self.rates = None
+        self.refresh = 0
+        self.pending = 0
+        self.last = time.monotonic()
+
+    def __buckets(self):
+        # Schedules are evaluated at most once per minute
+        if time.monotonic() >= self.refresh:
+            self.rates = rates()
+            self.refresh = time.monotonic() + 60
+
+        result = []
+        if self.rates["global"] is not None:
+            result.append(("global", self.rates["global"]))
+        rate = self.rates["clusters"].get(self.cluster)
+        if self.cluster is not None and rate is not None:
+            result.append((f"cluster-{self.cluster}", rate))
+        rate = self.rates["endpoints"].get(self.endpoint)
+        if self.endpoint is not None and rate is not None:
+            result.append((f"endpoint-{self.endpoint}", rate))
+        return result
+
+    def __call__(self, size):
+        self.pending += size
+        now = time.monotonic()
+        if self.pending < BATCH and now - self.last < SLICE:
+            return
+        size = self.pending
+        self.pending = 0
+        self.last = now
+
+        delay = 0
+        for name, rate in self.__buckets():
+            if rate <= 0:
+                continue
+            delay = max(delay, Bucket(name).reserve(size, rate))
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_shaper(cluster=None, endpoint=None):
+    conf = config["bandwidth"]
+    if (
+        conf["global"] is None
+        and len(conf["clusters"]) == 0
+        and len(conf["endpoints"]) == 0
+        and len(conf["schedule"]) == 0
+    ):
+        return None
+    return Shaper(cluster, endpoint)
@@ -0,0 +1,67 @@
+import contextlib
+import random
+import time
+
+import filelock
+
+from .config import config
+from .log import log as Log
+
+
+class Slot:
+    # A counting semaphore shared by every process: count lock files, we
+    # hold whichever is free. Locks are released by the kernel if we die
+    def __init__(self, kind, name, count):
+        name = str(name).replace("/", "")
+        self.desc = f"{kind} {name}"
+        self.locks = [
+            filelock.FileLock(f"{config['lockdir']}/slot-{kind}-{name}-{i}", timeout=0)
+            for i in range(count)
+        ]
+        self.held = None
+
+    def __try(self):
+        # Start anywhere, so that processes do not all fight for slot 0
+        start = random.randrange(len(self.locks))
+        for lock in self.locks[start:] + self.locks[:start]:
+            try:
+                lock.acquire()
+                return lock
+            except filelock.Timeout:
+                continue
+        return None
+
+    def __enter__(self):
+        self.held = self.__try()
+        if self.held is not None:
+            return self
+
+        Log.debug(f"Waiting for a free slot on {self.desc}")
+        delay = 0.01
+        while self.held is None:
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+            self.held = self.__try()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.held.release()
+        self.held = None
+
+
+def acquire(cluster=None, endpoint=None):
+    # Every budget that applies to a transfer
+    # Always taken in the same order: backup, cluster, endpoint
+    conf = config["concurrency"]
+    stack = contextlib.ExitStack()
+    wanted = [
+        ("backup", "local", conf["backup"]),
+        ("cluster", cluster, conf["clusters"].get(cluster, conf["cluster"])),
+        ("endpoint", endpoint, conf["endpoints"].get(endpoint, conf["endpoint"])),
+    ]
+    with stack:
+        for kind, name, count in wanted:
+            if name is None or count is None:
+                continue
+            stack.enter_context(Slot(kind, name, count))
+        return stack.pop_all()
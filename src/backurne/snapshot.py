@@ -0,0 +1,94 @@
+import datetime
+import functools
+
+import dateutil.parser
+
+from .config import config
+from .log import log as Log
+
+
+PERIODS = {
+    "hourly": 3600,
+    "daily": 86400,
+    "weekly": 7 * 86400,
+    "monthly": 30 * 86400,
+}
+
+
+def parse_date(text):
+    # Our own names are written by isoformat(): skip dateutil's guessing
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return dateutil.parser.parse(text)
+
+
+class Snap:
+    # A snapshot name: prefix;profile;value;date
+    # A coalesced snapshot carries several profiles and their values,
+    # comma-separated: it expires along with the longest of them
+    # Everything is computed once: sorting and expiring many snapshots is
+    # plain arithmetic
+    __slots__ = (
+        "name",
+        "profile",
+        "profiles",
+        "values",
+        "date",
+        "timestamp",
+        "expires_at",
+    )
+
+    def __init__(self, name):
+        split = name.split(";")
+        if len(split) < 4:
+            raise ValueError(f"Invalid snapshot name: {name}")
+        self.name = name
+        self.profile = split[-3]
+        self.profiles = tuple(self.profile.split(","))
+        self.values = tuple(int(i) for i in split[-2].split(","))
+        if len(self.values) != len(self.profiles):
+            raise ValueError(f"Invalid snapshot name: {name}")
+        self.date = parse_date(split[-1])
+        self.timestamp = self.date.timestamp()
+
+        self.expires_at = None
+        for profile, value in zip(self.profiles, self.values):
+            period = PERIODS.get(profile)
+            if period is None:
+                # Unknown profile: we cannot tell when it expires
+                self.expires_at = None
+                break
+            expires_at = self.timestamp + period * value
+            if self.expires_at is None or expires_at > self.expires_at:
+                self.expires_at = expires_at
+
+    def __repr__(self):
+        return f"Snap({self.name})"
+
+    def is_expired(self, last=False, now=None):
+        if self.expires_at is None:
+            Log.warning(f"Unknown profile found, no action taken: {self.profile}")
+            return False
+
+        expires_at = self.expires_at
+        if last is True:
+            expires_at += config["extra_retention_time"] * 86400
+
+        if now is None:
+            now = datetime.datetime.now().timestamp()
+        return expires_at <= now
+
+
+@functools.lru_cache(maxsize=1 << 20)
+def parse(name):
+    return Snap(name)
+
+
+def sort_key(name):
+    return parse(name).timestamp
+
+
+def last(names):
+    # The most recent snapshot, or None
+    return max(names, key=sort_key, default=None)
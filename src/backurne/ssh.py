@@ -0,0 +1,89 @@
+import hashlib
+import os
+import time
+
+import sh
+
+from .config import config
+from .log import log as Log
+
+
+class SshPool:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.conf = config["ssh"]
+        self.last_check = {}
+
+    def control_path(self):
+        if self.conf["multiplex"] is not True:
+            return None
+
+        # Each process sticks to one of the master connections
+        # That way, at most "connections" masters exist per endpoint
+        slot = os.getpid() % self.conf["connections"]
+
+        # Unix sockets have a short path limit, so we hash the endpoint
+        name = hashlib.sha1(self.endpoint.encode("utf-8")).hexdigest()[:16]
+        return f"{self.conf['control_dir']}/{name}-{slot}"
+
+    def __options(self, path):
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={path}",
+            "-o",
+            f"ControlPersist={self.conf['persist']}",
+            "-o",
+            f"ServerAliveInterval={self.conf['alive_interval']}",
+            "-o",
+            "ServerAliveCountMax=3",
+        ]
+
+    def check(self, path):
+        if not os.path.exists(path):
+            # No master yet, the next command will create it
+            return True
+        try:
+            sh.Command("ssh")("-O", "check", "-o", f"ControlPath={path}", self.endpoint)
+            return True
+        except sh.ErrorReturnCode:
+            return False
+
+    def reset(self, path):
+        Log.debug(f"Master connection {path} to {self.endpoint} is dead, resetting")
+        try:
+            sh.Command("ssh")("-O", "exit", "-o", f"ControlPath={path}", self.endpoint)
+        except sh.ErrorReturnCode:
+            pass
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def command(self, path):
+        ssh = sh.Command("ssh").bake("-n")
+        if path is None:
+            return ssh.bake(self.endpoint)
+        return ssh.bake(*self.__options(path), self.endpoint)
+
+    def ready(self, path):
+        # Called before each use of the master connection: a dead one is
+        # torn down, so the command creates a new one
+        now = time.monotonic()
+        if now - self.last_check.get(path, 0) <= self.conf["check_interval"]:
+            return
+        if len(self.last_check) == 0:
+            os.makedirs(self.conf["control_dir"], mode=0o700, exist_ok=True)
+        if not self.check(path):
+            self.reset(path)
+        self.last_check[path] = now
+
+
+pools = {}
+
+
+def get_pool(endpoint):
+    if endpoint not in pools:
+        pools[endpoint] = SshPool(endpoint)
+    return pools[endpoint]
@@ -0,0 +1,120 @@
+import os
+import sqlite3
+import threading
+
+from .config import config
+
+
+# Connections cannot be shared between threads, nor across a fork: each
+# thread of each process opens its own, once. Those inherited from our
+# parent are never used, nor closed
+local = threading.local()
+
+# The databases whose schema was created by this process, or its parent
+ready = set()
+
+
+# Local state, kept across runs
+def get_db():
+    path = config["state_db"]
+    key = (os.getpid(), path)
+    if not hasattr(local, "dbs"):
+        local.dbs = {}
+    if key in local.dbs:
+        return local.dbs[key]
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, isolation_level=None, timeout=60)
+    local.dbs[key] = db
+    if path in ready:
+        return db
+    ready.add(path)
+
+    db.execute(
+        "create table if not exists checkpoints (dest text, snap text, "
+        "last_snap text, start integer, end integer, done integer, "
+        "primary key (dest, snap, start))"
+    )
+    db.execute(
+        "create table if not exists compression (dest text, codec text, "
+        "level integer, ratio real, throughput real, date integer)"
+    )
+    db.execute(
+        "create table if not exists estimates (dest text, snap text, "
+        "estimated integer, actual integer, date integer, primary key (dest, snap))"
+    )
+    db.execute(
+        "create table if not exists manifests (key text, image text, snap text, "
+        "size integer, chunk integer, digests blob, primary key (key, image, snap))"
+    )
+    db.execute(
+        "create table if not exists runs (run integer primary key, "
+        "start integer, end integer, pid integer, host text)"
+    )
+    db.execute(
+        "create table if not exists journal (run integer, cluster text, "
+        "dest text, snap text, last_snap text, priority integer, state text, "
+        "updated integer, primary key (dest, snap))"
+    )
+    return db
+
+
+class Checkpoint:
+    # Progress of an extent-based transfer, range by range
+    def __init__(self, dest, snap, last_snap):
+        self.dest = dest
+        self.snap = snap
+        self.last_snap = last_snap
+        self.db = get_db()
+
+    def pending(self):
+        # The ranges left to transfer, or None if no transfer was started
+        rows = self.db.execute(
+            "select start, end, done, last_snap from checkpoints "
+            "where dest = ? and snap = ? order by start",
+            (self.dest, self.snap),
+        ).fetchall()
+        if len(rows) == 0:
+            return None
+        if rows[0][3] != self.last_snap:
+            # Started from another base, it is useless
+            self.drop()
+            return None
+        return [(i[0], i[1]) for i in rows if i[2] == 0]
+
+    def start(self, ranges):
+        self.drop()
+        self.db.executemany(
+            "insert into checkpoints values (?, ?, ?, ?, ?, 0)",
+            [(self.dest, self.snap, self.last_snap, i[0], i[1]) for i in ranges],
+        )
+
+    def done(self, _range):
+        self.db.execute(
+            "update checkpoints set done = 1 where dest = ? and snap = ? and start = ?",
+            (self.dest, self.snap, _range[0]),
+        )
+
+    def drop(self):
+        self.db.execute(
+            "delete from checkpoints where dest = ? and snap = ?",
+            (self.dest, self.snap),
+        )
+
+
+def checkpointed():
+    # Every backup image with some interrupted transfer
+    rows = get_db().execute("select distinct dest from checkpoints")
+    return {i[0] for i in rows}
+
+
+def drop_checkpoints(dest):
+    get_db().execute("delete from checkpoints where dest = ?", (dest,))
+
+
+def interrupted(dest):
+    # Transfers to dest that were started, yet never completed
+    rows = get_db().execute(
+        "select distinct snap, last_snap from checkpoints where dest = ?", (dest,)
+    )
+    return rows.fetchall()
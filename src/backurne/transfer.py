@@ -0,0 +1,183 @@
+import datetime
+import os
+import threading
+from subprocess import PIPE
+from subprocess import Popen
+
+from .log import log as Log
+
+
+BUFSIZE = 4 * 1024 * 1024
+
+
+class TransferError(Exception):
+    pass
+
+
+class Result:
+    def __init__(self):
+        # Bytes read from the export, and bytes fed to the last import
+        # They differ when the stream is compressed
+        self.bytes = 0
+        self.raw_bytes = 0
+        # CPU time of the remote compressor, in seconds, if known
+        self.compress_cpu = None
+        self.export_rc = None
+        self.import_rc = []
+        self.start = datetime.datetime.now()
+        self.end = None
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else datetime.datetime.now()
+        return end - self.start
+
+    @property
+    def throughput(self):
+        seconds = self.duration.total_seconds()
+        if seconds == 0:
+            return 0
+        return self.bytes / seconds
+
+    @property
+    def success(self):
+        if self.export_rc != 0:
+            return False
+        return all(i == 0 for i in self.import_rc)
+
+    def __str__(self):
+        return (
+            f"{self.bytes} bytes in {self.duration} "
+            f"({int(self.throughput)} B/s, export rc {self.export_rc}, "
+            f"import rc {self.import_rc})"
+        )
+
+
+class Transfer:
+    # Runs an export command and pipes its output through a chain of
+    # import commands. We own both ends of the pipe: data is copied
+    # by ourselves, so we know how much went through, and the import side
+    # only sees EOF once we know that the export succeeded.
+    def __init__(self, export, imports, on_stderr=None, on_data=None):
+        self.export = export
+        self.imports = imports
+        self.on_stderr = on_stderr
+        self.on_data = on_data
+        self.result = Result()
+        self.procs = []
+
+    def __spawn(self):
+        stderr = PIPE if self.on_stderr is not None else None
+        exp = Popen(self.export, stdout=PIPE, stderr=stderr)
+        self.procs.append(exp)
+
+        imps = []
+        for pos, cmd in enumerate(self.imports):
+            stdout = PIPE if pos < len(self.imports) - 1 else None
+            imps.append(Popen(cmd, stdin=PIPE, stdout=stdout))
+        self.procs += imps
+        return exp, imps
+
+    def __copy(self, src, dst, counter="bytes"):
+        use_splice = hasattr(os, "splice")
+        while True:
+            if use_splice:
+                try:
+                    size = os.splice(src, dst, BUFSIZE)
+                except OSError:
+                    # Not supported here, fallback to a regular copy
+                    use_splice = False
+                    continue
+            else:
+                data = os.read(src, BUFSIZE)
+                size = len(data)
+                view = memoryview(data)
+                while len(view) > 0:
+                    written = os.write(dst, view)
+                    view = view[written:]
+
+            if size == 0:
+                return
+            if counter is not None:
+                setattr(self.result, counter, getattr(self.result, counter) + size)
+            if self.on_data is not None and counter == "bytes":
+                self.on_data(size)
+
+    def __relay(self, src, dst, counter):
+        # Copy data between two import stages
+        # Failures show up in the exit codes
+        try:
+            self.__copy(src.fileno(), dst.fileno(), counter)
+        except OSError:
+            pass
+        src.close()
+        try:
+            dst.close()
+        except BrokenPipeError:
+            pass
+
+    def kill(self):
+        for p in self.procs:
+            if p.poll() is None:
+                p.kill()
+
+    def __call__(self):
+        exp, imps = self.__spawn()
+
+        reader = None
+        if self.on_stderr is not None:
+            reader = threading.Thread(target=self.on_stderr, args=(exp.stderr,))
+            reader.start()
+
+        relays = []
+        for pos in range(1, len(imps)):
+            counter = "raw_bytes" if pos == len(imps) - 1 else None
+            relay = threading.Thread(
+                target=self.__relay,
+                args=(imps[pos - 1].stdout, imps[pos].stdin, counter),
+            )
+            relay.start()
+            relays.append(relay)
+
+        failure = None
+        try:
+            self.__copy(exp.stdout.fileno(), imps[0].stdin.fileno())
+        except BrokenPipeError:
+            failure = "import side closed its input"
+        except OSError as e:
+            failure = f"copy failed: {e}"
+
+        if failure is not None:
+            # The importer is gone, no need to keep exporting
+            exp.kill()
+        self.result.export_rc = exp.wait()
+        exp.stdout.close()
+
+        if failure is None and self.result.export_rc != 0:
+            failure = f"export exited with code {self.result.export_rc}"
+
+        if failure is not None:
+            # Never let the import side see a clean EOF after a failure
+            # It would apply a truncated stream
+            for p in imps:
+                p.kill()
+        try:
+            imps[0].stdin.close()
+        except BrokenPipeError:
+            pass
+
+        self.result.import_rc = [p.wait() for p in imps]
+        for relay in relays:
+            relay.join()
+        if len(imps) == 1:
+            self.result.raw_bytes = self.result.bytes
+        if reader is not None:
+            reader.join()
+        self.result.end = datetime.datetime.now()
+
+        if failure is None and not self.result.success:
+            failure = f"import exited with codes {self.result.import_rc}"
+        if failure is not None:
+            Log.debug(f"Transfer failed: {self.result}")
+            raise TransferError(failure)
+        return self.result
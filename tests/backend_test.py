@@ -0,0 +1,64 @@
+import pytest
+
+from backurne import backend
+from backurne import inventory
+
+
+def test_fake_images():
+    fake = backend.FakeBackend()
+    fake.create("img", 4096)
+    assert fake.ls() == ["img"]
+    assert fake.exists("img")
+    assert fake.info("img")["size"] == 4096
+    with pytest.raises(backend.Error):
+        fake.create("img", 1)
+
+    fake.rename("img", "dest")
+    assert fake.ls() == ["dest"]
+    fake.rm("dest")
+    assert not fake.exists("dest")
+    with pytest.raises(backend.NotFound):
+        fake.info("dest")
+
+
+def test_fake_snaps():
+    fake = backend.FakeBackend()
+    fake.create("img", 1)
+    fake.snap_create("img", "a")
+    fake.snap_create("img", "b")
+    assert fake.snaps("img") == ["a", "b"]
+
+    fake.protect("img", "a")
+    assert fake.is_protected("img", "a")
+    assert fake.info("img@a")["protected"] == "true"
+    assert fake.snap_entries("img") == [
+        {"name": "a", "protected": True},
+        {"name": "b", "protected": False},
+    ]
+    # Protected snapshots cannot be removed, nor can their image
+    with pytest.raises(backend.Error):
+        fake.snap_rm("img", "a")
+    with pytest.raises(backend.Error):
+        fake.rm("img")
+
+    fake.unprotect("img", "a")
+    fake.snap_purge("img")
+    assert fake.snaps("img") == []
+    fake.rm("img")
+
+
+def test_fake_entries():
+    # What load_inventory builds upon
+    fake = backend.FakeBackend()
+    fake.create("img", 1)
+    fake.snap_create("img", "a")
+    fake.snap_create("img", "b")
+    fake.protect("img", "b")
+    fake.create("empty", 1)
+
+    inv = inventory.Inventory(fake.entries())
+    assert sorted(inv.ls()) == ["empty", "img"]
+    assert inv.snap("img") == ["a", "b"]
+    assert inv.snap("empty") == []
+    assert not inv.protected("img", "a")
+    assert inv.protected("img", "b")
@@ -0,0 +1,28 @@
+import subprocess
+
+from backurne import compress
+
+
+def test_cpu_time():
+    stderr = b"Exporting image: 100% complete...done.\r\n"
+    stderr += compress.MARK + b"\n0m0.010s 0m0.000s\n1m2.500s 0m0.250s\n"
+    assert compress.cpu_time(stderr) == 62.75
+
+
+def test_cpu_time_missing():
+    assert compress.cpu_time(b"rbd: error opening image\n") is None
+    assert compress.cpu_time(compress.MARK + b"\n") is None
+
+
+def test_timed_cmd():
+    conf = {"codec": "zstd", "threads": 1}
+    cmd = compress.timed_cmd(conf, 3).replace("zstd -q -c -3 -T1", "cat")
+    run = subprocess.run(
+        ["bash", "-c", cmd], input=b"data", capture_output=True, check=True
+    )
+    assert run.stdout == b"data"
+    assert compress.cpu_time(run.stderr) is not None
+
+    # The compressor's exit code is kept
+    cmd = compress.timed_cmd(conf, 3).replace("zstd -q -c -3 -T1", "false")
+    assert subprocess.run(["bash", "-c", cmd], capture_output=True).returncode == 1
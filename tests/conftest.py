@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from backurne.config import config  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def settings(tmp_path, monkeypatch):
+    monkeypatch.setitem(config, "state_db", str(tmp_path / "state.db"))
+    monkeypatch.setitem(config, "lockdir", str(tmp_path))
+    monkeypatch.setitem(config, "snap_prefix", "backup")
+    monkeypatch.setitem(config, "extra_retention_time", 0)
+    monkeypatch.setitem(
+        config,
+        "profiles",
+        {
+            "daily": {"count": 30, "max_on_live": 1},
+            "weekly": {"count": 4, "max_on_live": 0},
+        },
+    )
+    return config
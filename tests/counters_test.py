@@ -0,0 +1,33 @@
+import os
+
+from backurne import cache
+from backurne import counters
+
+
+def test_cache_counters(settings, tmp_path, monkeypatch):
+    monkeypatch.setitem(settings, "metadata_cache", {"size": 10, "ttl": 60})
+    monkeypatch.setitem(
+        settings, "progress", {**settings["progress"], "dir": str(tmp_path)}
+    )
+    # Lookups of the previous tests are not ours
+    cache.take()
+
+    lookups = cache.Cache()
+    lookups.get(("info", "image"), lambda: 1)
+    lookups.get(("info", "image"), lambda: 1)
+
+    status = counters.Counters(["cluster", None])
+    try:
+        status.add("cluster", "snapshot", total=1)
+        pid = os.fork()
+        if pid == 0:
+            lookups.get(("snap", "image"), lambda: 1)
+            status.add("cluster", "snapshot", done=1)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        run = [i for i in counters.read() if i["pid"] == os.getpid()][0]
+        assert run["cache"]["info"] == {"hits": 1, "misses": 1}
+        assert run["cache"]["snap"] == {"hits": 0, "misses": 1}
+    finally:
+        status.close()
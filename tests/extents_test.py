@@ -0,0 +1,43 @@
+from backurne import extents
+
+
+def extent(offset, length):
+    return {"offset": offset, "length": length, "exists": True}
+
+
+def covers(ranges, size):
+    return (
+        ranges[0][0] == 0
+        and ranges[-1][1] == size
+        and all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+    )
+
+
+def test_split_nothing_changed():
+    assert extents.split([], 4, 100) == [(0, 100)]
+
+
+def test_split_single():
+    assert extents.split([extent(0, 10)], 1, 100) == [(0, 100)]
+
+
+def test_split_balanced():
+    data = [extent(i * 10, 10) for i in range(8)]
+    ranges = extents.split(data, 4, 100)
+    assert ranges == [(0, 20), (20, 40), (40, 60), (60, 100)]
+
+
+def test_split_cuts_on_extents():
+    data = [extent(0, 50), extent(60, 10), extent(90, 10)]
+    ranges = extents.split(data, 4, 100)
+    assert len(ranges) <= 4
+    assert covers(ranges, 100)
+    ends = {i["offset"] + i["length"] for i in data} | {100}
+    assert all(i[1] in ends for i in ranges)
+
+
+def test_header():
+    assert (
+        extents.header(4096) == b"rbd diff v1\ns" + (4096).to_bytes(8, "little") + b"e"
+    )
+    assert extents.header(4096, "base").startswith(b"rbd diff v1\nf\x04\0\0\0base")
@@ -0,0 +1,55 @@
+import hashlib
+
+from backurne import manifest
+from backurne.manifest import CHUNK
+from backurne.manifest import Manifest
+
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=manifest.DIGEST).digest()
+
+
+def empty():
+    return Manifest(0, 0, b"")
+
+
+def test_derive_full():
+    result = empty().derive(3 * CHUNK, CHUNK, [(0, digest(b"a")), (2, digest(b"c"))])
+    assert result.count == 3
+    assert result.digest(0) == digest(b"a")
+    # Never written: zeroes
+    assert result.digest(1) == manifest.zero_digest(CHUNK)
+    assert result.digest(2) == digest(b"c")
+
+
+def test_derive_incremental():
+    base = empty().derive(2 * CHUNK, CHUNK, [(0, digest(b"a")), (1, digest(b"b"))])
+    result = base.derive(2 * CHUNK, CHUNK, [(1, digest(b"B"))])
+    assert result.digest(0) == digest(b"a")
+    assert result.digest(1) == digest(b"B")
+
+
+def test_derive_resized():
+    base = empty().derive(2 * CHUNK, CHUNK, [(0, digest(b"a")), (1, digest(b"b"))])
+    grown = base.derive(3 * CHUNK, CHUNK, [])
+    assert grown.count == 3
+    assert grown.digest(2) == manifest.zero_digest(CHUNK)
+    shrunk = base.derive(CHUNK, CHUNK, [])
+    assert shrunk.count == 1
+    assert shrunk.digests == digest(b"a")
+
+
+def test_diff():
+    one = empty().derive(3 * CHUNK, CHUNK, [(0, digest(b"a"))])
+    assert one.diff(one) == []
+    other = one.derive(3 * CHUNK, CHUNK, [(2, digest(b"c"))])
+    assert one.diff(other) == [2 * CHUNK]
+    # Sizes differ
+    assert one.diff(one.derive(4 * CHUNK, CHUNK, [])) is None
+
+
+def test_parse():
+    records = [(0, digest(b"a")), (5, digest(b"f"))]
+    output = b'{"size": 42, "chunk": 4194304}\n'
+    output += b"".join(manifest.RECORD.pack(*i) for i in records)
+    assert manifest.parse(output) == (42, CHUNK, records)
@@ -0,0 +1,183 @@
+import datetime
+
+from backurne import backend
+from backurne import inventory
+from backurne import retention
+from backurne import state
+
+
+NOW = datetime.datetime(2026, 6, 1, 12, 0)
+
+
+def name(profile, value, days):
+    date = NOW - datetime.timedelta(days=days)
+    return f"backup;{profile};{value};{date.isoformat()}"
+
+
+def plan(snaps, protected=()):
+    return retention.plan_image("img", snaps, protected, NOW.timestamp())
+
+
+def test_plan_image_all_expired():
+    snaps = [name("daily", 1, 3), name("daily", 1, 2)]
+    result = plan(snaps)
+    assert result["snaps"] == snaps
+    assert result["last"] and result["rm"] and result["purge"]
+
+
+def test_plan_image_keeps_last_during_extra_retention(settings):
+    settings["extra_retention_time"] = 5
+    snaps = [name("daily", 1, 3), name("daily", 1, 2)]
+    result = plan(snaps)
+    assert result["snaps"] == snaps[:1]
+    assert not result["last"] and not result["rm"]
+
+
+def test_plan_image_partial():
+    snaps = [name("daily", 1, 3), name("daily", 30, 2), name("daily", 1, 1)]
+    result = plan(snaps)
+    assert result["snaps"] == snaps[:1]
+    assert not result["last"] and not result["rm"] and not result["purge"]
+
+
+def test_plan_image_protected():
+    snaps = [name("daily", 1, 3), name("daily", 1, 2)]
+    result = plan(snaps, protected=snaps[:1])
+    assert result["protected"] == snaps[:1]
+    # The last snapshot only goes with all the others
+    assert result["snaps"] == []
+    assert not result["rm"]
+
+
+def test_plan_image_foreign_snapshot():
+    snaps = ["manual", name("daily", 1, 2)]
+    result = plan(snaps)
+    assert result["snaps"] == snaps[1:]
+    assert result["last"]
+    assert not result["rm"] and not result["purge"]
+
+
+def test_plan_image_no_snapshot_of_ours():
+    assert plan([])["rm"]
+    assert not plan(["manual"])["rm"]
+
+
+def test_plan_image_unknown_profile():
+    snaps = [name("yearly", 1, 1000), name("daily", 1, 3)]
+    result = plan(snaps)
+    assert result["snaps"] == []
+    assert not result["rm"]
+
+
+def test_plan_live_max_on_live():
+    snaps = [name("daily", 30, i) for i in (4, 3, 2, 1)]
+    # Only the newest is on the backup cluster: it is kept, and so is
+    # max_on_live (1) older daily snapshot
+    result = retention.plan_live(snaps, snaps[-1:])
+    assert result == snaps[:2]
+
+
+def test_plan_live_nothing_shared():
+    snaps = [name("daily", 30, i) for i in (2, 1)]
+    assert retention.plan_live(snaps, []) == []
+
+
+def test_plan_live_unknown_profile():
+    snaps = [name("yearly", 1, 2), name("daily", 30, 1)]
+    assert retention.plan_live(snaps, snaps[-1:]) == snaps[:1]
+
+
+def test_plan_live_coalesced():
+    # weekly keeps nothing on live, daily keeps the last one
+    snaps = [name("daily", 30, 3), name("daily,weekly", "30,4", 2)]
+    snaps.append(name("daily", 30, 1))
+    assert retention.plan_live(snaps, snaps[-1:]) == snaps[:1]
+
+
+def test_recheck_unchanged():
+    snaps = [name("daily", 1, 3), name("daily", 1, 2)]
+    planned = plan(snaps)
+    assert retention.recheck(planned, snaps) == planned
+
+
+def test_recheck_new_snapshot():
+    snaps = [name("daily", 1, 3), name("daily", 1, 2)]
+    planned = plan(snaps)
+    result = retention.recheck(planned, snaps + [name("daily", 1, 0)])
+    assert result["snaps"] == snaps
+    assert not result["last"] and not result["rm"] and not result["purge"]
+
+
+def test_recheck_removed_snapshot():
+    snaps = [name("daily", 1, 3), name("daily", 1, 2)]
+    result = retention.recheck(plan(snaps), snaps[1:])
+    assert result["snaps"] == snaps[1:]
+    assert not result["rm"] and not result["purge"]
+
+
+class Pool:
+    # What plan_backup needs from a Ceph object
+    def __init__(self, fake):
+        self.backend = fake
+        self.inventory = inventory.Inventory(fake.entries())
+
+    def ls(self):
+        return self.inventory.ls()
+
+    def exists(self, image):
+        return self.inventory.exists(image)
+
+
+class Bare(Pool):
+    # Without inventory, as when rbd ls --long failed
+    def __init__(self, fake):
+        self.backend = fake
+        self.inventory = None
+
+    def ls(self):
+        return self.backend.ls()
+
+    def exists(self, image):
+        return self.backend.exists(image)
+
+
+def test_plan_backup():
+    fake = backend.FakeBackend()
+    for image in ("expired", "young", "pending", "empty"):
+        fake.create(image, 1)
+    fake.snap_create("expired", name("daily", 1, 3))
+    fake.snap_create("young", name("daily", 30, 1))
+    fake.snap_create("pending", name("daily", 1, 3))
+    # An interrupted transfer: its partial data must stay
+    state.Checkpoint("pending", name("daily", 1, 0), None).start([(0, 1)])
+
+    plans = retention.plan_backup(Pool(fake), NOW.timestamp())
+    assert {i["image"]: i["rm"] for i in plans} == {"expired": True, "empty": True}
+
+    state.drop_checkpoints("pending")
+    plans = retention.plan_backup(Pool(fake), NOW.timestamp())
+    assert "pending" in [i["image"] for i in plans]
+
+
+def test_plan_backup_no_inventory():
+    fake = backend.FakeBackend()
+    fake.create("img", 1)
+    snaps = [name("daily", 1, 3), name("daily", 1, 2)]
+    for snap in snaps:
+        fake.snap_create("img", snap)
+    fake.protect("img", snaps[0])
+
+    plans = retention.plan_backup(Bare(fake), NOW.timestamp())
+    assert plans[0]["protected"] == snaps[:1]
+    assert not plans[0]["rm"]
+
+
+def test_report():
+    report = retention.Report()
+    result = retention.result()
+    result["snaps"] = 2
+    result["removed"] = [("img", "a"), ("img", "b")]
+    report.add(result)
+    report.add(retention.result())
+    assert report.snaps == 2
+    assert report.removed == [("img", "a"), ("img", "b")]
@@ -0,0 +1,38 @@
+import threading
+
+from backurne import scheduler
+
+
+def test_priority():
+    assert scheduler.priority(None) == 0
+    assert scheduler.priority("high") > scheduler.priority("low")
+    assert scheduler.priority(42) == 42
+    assert scheduler.priority("unknown") == 0
+
+
+def test_order():
+    queue = scheduler.Scheduler()
+    queue.put("first", 0, 0)
+    queue.put("small", 0, -10)
+    queue.put("urgent", 10, 0)
+    queue.put("second", 0, 0)
+    queue.put("late", -10, -100)
+    queue.close()
+    result = []
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        result.append(item)
+    assert result == ["urgent", "small", "first", "second", "late"]
+    assert queue.get() is None
+
+
+def test_get_blocks_until_work():
+    queue = scheduler.Scheduler()
+    result = []
+    consumer = threading.Thread(target=lambda: result.append(queue.get()))
+    consumer.start()
+    queue.put("work")
+    consumer.join(5)
+    assert result == ["work"]
@@ -0,0 +1,74 @@
+import datetime
+
+import pytest
+
+from backurne import snapshot
+
+
+NOW = datetime.datetime(2026, 6, 1, 12, 0)
+
+
+def name(profile, value, days):
+    date = NOW - datetime.timedelta(days=days)
+    return f"backup;{profile};{value};{date.isoformat()}"
+
+
+def test_parse():
+    snap = snapshot.parse(name("daily", 30, 0))
+    assert snap.profile == "daily"
+    assert snap.profiles == ("daily",)
+    assert snap.values == (30,)
+    assert snap.date == NOW
+    assert snap.expires_at == NOW.timestamp() + 30 * 86400
+
+
+def test_parse_coalesced():
+    snap = snapshot.parse(name("daily,weekly", "30,52", 0))
+    assert snap.profiles == ("daily", "weekly")
+    assert snap.values == (30, 52)
+    # The longest retention wins
+    assert snap.expires_at == NOW.timestamp() + 52 * 7 * 86400
+    snap = snapshot.parse(name("daily,weekly", "30,4", 0))
+    assert snap.expires_at == NOW.timestamp() + 30 * 86400
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "backup;daily;2026-06-01T12:00:00",
+        "backup;daily,weekly;30;2026-06-01T12:00:00",
+        "backup;daily;thirty;2026-06-01T12:00:00",
+    ],
+)
+def test_parse_invalid(text):
+    with pytest.raises(ValueError):
+        snapshot.Snap(text)
+
+
+def test_is_expired():
+    snap = snapshot.parse(name("daily", 2, 3))
+    assert snap.is_expired(now=NOW.timestamp())
+    snap = snapshot.parse(name("daily", 2, 1))
+    assert not snap.is_expired(now=NOW.timestamp())
+
+
+def test_is_expired_last(settings):
+    settings["extra_retention_time"] = 2
+    snap = snapshot.parse(name("daily", 2, 3))
+    assert snap.is_expired(now=NOW.timestamp())
+    assert not snap.is_expired(last=True, now=NOW.timestamp())
+    snap = snapshot.parse(name("daily", 2, 5))
+    assert snap.is_expired(last=True, now=NOW.timestamp())
+
+
+@pytest.mark.parametrize("profile,value", [("yearly", "1"), ("daily,yearly", "1,1")])
+def test_unknown_profile(profile, value):
+    snap = snapshot.parse(name(profile, value, 1000))
+    assert snap.expires_at is None
+    assert not snap.is_expired(now=NOW.timestamp())
+
+
+def test_last():
+    names = [name("daily", 30, i) for i in (3, 1, 2)]
+    assert snapshot.last(names) == names[1]
+    assert snapshot.last([]) is None
@@ -0,0 +1,40 @@
+from backurne import state
+
+
+def test_checkpoint():
+    checkpoint = state.Checkpoint("dest", "snap", "base")
+    assert checkpoint.pending() is None
+
+    checkpoint.start([(0, 10), (10, 20)])
+    assert checkpoint.pending() == [(0, 10), (10, 20)]
+    checkpoint.done((0, 10))
+    assert state.Checkpoint("dest", "snap", "base").pending() == [(10, 20)]
+
+    # Every range is applied, only the snapshot is missing
+    checkpoint.done((10, 20))
+    assert state.Checkpoint("dest", "snap", "base").pending() == []
+    assert state.interrupted("dest") == [("snap", "base")]
+    assert state.checkpointed() == {"dest"}
+
+    checkpoint.drop()
+    assert checkpoint.pending() is None
+    assert state.checkpointed() == set()
+
+
+def test_checkpoint_other_base():
+    state.Checkpoint("dest", "snap", "base").start([(0, 10)])
+    # Started from another base, it is useless
+    assert state.Checkpoint("dest", "snap", "other").pending() is None
+    assert state.interrupted("dest") == []
+
+
+def test_drop_checkpoints():
+    state.Checkpoint("dest", "a", None).start([(0, 10)])
+    state.Checkpoint("dest", "b", None).start([(0, 10)])
+    state.Checkpoint("other", "a", None).start([(0, 10)])
+    state.drop_checkpoints("dest")
+    assert state.checkpointed() == {"other"}
+
+
+def test_get_db_is_cached():
+    assert state.get_db() is state.get_db()